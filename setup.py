@@ -15,4 +15,7 @@ setup(
         'torch',
         'uuid'
     ],
+    entry_points={
+        'console_scripts': ['vlite=vlite.cli:main'],
+    },
 )
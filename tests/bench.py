@@ -84,7 +84,7 @@ def main(query, corpuss, top_k, token_counts) -> pd.DataFrame:
             query_vector = query[i]
             t0 = time.time()
             try:
-                texts, top_sims = vlite.remember(query_vector, top_k=top_k)
+                texts, metadata, top_sims = vlite.remember(query_vector, top_k=top_k)
             except Exception as e:
                 print(e)
                 continue
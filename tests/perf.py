@@ -0,0 +1,213 @@
+"""
+Offline performance benchmarks for vlite.
+
+Every operation runs against a stub embedder that hashes texts into deterministic
+pseudo-random vectors, so the numbers measure the database itself, need no model
+download or network, and are the same from run to run. Each scale runs in a fresh
+process, and its peak RSS is reported as the growth over the RSS of that process after
+importing vlite, as torch and transformers alone take hundreds of megabytes.
+
+    python tests/perf.py --scales 1000 10000 100000 --output perf.json
+    python tests/perf.py --baseline tests/perf_baseline.json  # flags regressions, exits with 1
+
+tests/perf_baseline.json holds the results of the default scales on the machine
+described in its "meta" entry. Timings only compare on similar hardware, so write a
+baseline of your own with --output before comparing against it on another machine.
+
+Measured per scale:
+    ingest         VLite.ingest of every row, including the final save
+    memorize_many  bulk insert of every row
+    memorize       single inserts
+    remember       single queries
+    remember_many  one batch of queries
+    forget         single deletes
+    save           writing the collection
+    open           loading the collection and running its first query
+    peak_rss_growth_mb  peak RSS of the process over its RSS after the imports
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vlite.main import VLite
+from vlite.utils import normalize
+
+
+class StubModel:
+    '''Stands in for EmbeddingModel, embedding a text as a vector derived from its hash.'''
+    model_name = 'stub'
+    device = 'cpu'
+
+    def __init__(self, dimension=384):
+        self.dimension = dimension
+
+    def embed(self, texts, max_seq_length=256, device=None):
+        if isinstance(texts, str):
+            texts = [texts]
+        if len(texts) == 0:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        raw = b''.join(hashlib.shake_128(text.encode('utf-8')).digest(self.dimension) for text in texts)
+        vectors = np.frombuffer(raw, dtype=np.int8).reshape(len(texts), self.dimension).astype(np.float32)
+        return normalize(vectors)
+
+
+def percentiles(times):
+    """Latency percentiles in milliseconds and operations per second of a list of durations."""
+    times = np.asarray(times)
+    p50, p90, p99 = np.percentile(times, [50, 90, 99]) * 1000
+    return {"p50_ms": p50, "p90_ms": p90, "p99_ms": p99, "ops_per_second": len(times) / times.sum()}
+
+
+def throughput(seconds, rows):
+    return {"seconds": seconds, "rows_per_second": rows / seconds}
+
+
+def timed(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def peak_rss_mb():
+    """The peak resident set size of this process so far, in megabytes."""
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def run_scale(rows, dimension, operations, dtype, index):
+    """Run every benchmark on a collection of `rows` rows and return the results."""
+    # vlite and its dependencies are imported by now, so this is their share of the peak
+    imported_rss = peak_rss_mb()
+    model = StubModel(dimension)
+    texts = [f"document {i}" for i in range(rows)]
+    queries = [f"query {i}" for i in range(operations)]
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        options = dict(model=model, cache_size=0, dtype=dtype, index=index)
+
+        db = VLite(os.path.join(directory, 'ingest.npz'), **options)
+        pages = (texts[start:start + 1000] for start in range(0, rows, 1000))
+        seconds = timed(lambda: db.ingest(pages, chunker=lambda page: [page], batch_size=1024, checkpoint_every=None))
+        results["ingest"] = throughput(seconds, rows)
+        del db
+
+        path = os.path.join(directory, 'bench.npz')
+        db = VLite(path, **options)
+        seconds = timed(lambda: db.memorize_many(texts, ids=range(rows), batch_size=4096))
+        results["memorize_many"] = throughput(seconds, rows)
+
+        results["memorize"] = percentiles([timed(lambda: db.memorize(f"extra {i}", id=f"extra {i}")) for i in range(operations)])
+        results["remember"] = percentiles([timed(lambda: db.remember(query, top_k=10)) for query in queries])
+        seconds = timed(lambda: db.remember_many(queries, top_k=10))
+        results["remember_many"] = {"seconds": seconds, "queries_per_second": operations / seconds}
+        results["forget"] = percentiles([timed(lambda: db.forget(f"extra {i}")) for i in range(operations)])
+        results["save"] = {"seconds": timed(db.save)}
+        del db
+
+        results["open"] = {"seconds": timed(lambda: VLite(path, **options).remember(queries[0], top_k=10))}
+    results["peak_rss_growth_mb"] = peak_rss_mb() - imported_rss
+    return results
+
+
+# Metrics compared against a baseline, and whether a larger value is better
+METRICS = {
+    "rows_per_second": True,
+    "ops_per_second": True,
+    "queries_per_second": True,
+    "p50_ms": False,
+    "p99_ms": False,
+    "seconds": False,
+    "peak_rss_growth_mb": False,
+}
+
+
+def compare(results, baseline, tolerance):
+    """List every metric that got worse than the baseline by more than `tolerance`, as a fraction."""
+    regressions = []
+    for scale, operations in results["results"].items():
+        base_operations = baseline["results"].get(scale, {})
+        for operation, metrics in operations.items():
+            base_metrics = base_operations.get(operation)
+            if base_metrics is None:
+                continue
+            if not isinstance(metrics, dict):
+                metrics, base_metrics = {operation: metrics}, {operation: base_metrics}
+            for metric, value in metrics.items():
+                if metric not in METRICS or metric not in base_metrics or base_metrics[metric] <= 0:
+                    continue
+                change = value / base_metrics[metric] - 1
+                worse = -change if METRICS[metric] else change
+                if worse > tolerance:
+                    regressions.append((scale, operation, metric, base_metrics[metric], value, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", type=int, nargs="+", default=[1000, 10000, 100000], help="Collection sizes to benchmark, up to 1000000.")
+    parser.add_argument("--dimension", type=int, default=384, help="Dimension of the stub embeddings.")
+    parser.add_argument("--operations", type=int, default=200, help="Number of timed single memorize, remember and forget calls.")
+    parser.add_argument("--dtype", default=None, choices=["float32", "float16", "int8"], help="Storage dtype of the collection.")
+    parser.add_argument("--index", default=None, choices=["ivf", "hnsw"], help="Search index of the collection.")
+    parser.add_argument("--output", default=None, help="Write the results as JSON to this file.")
+    parser.add_argument("--baseline", default=None, help="Compare against results written earlier with --output.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Fraction a metric may get worse before it is flagged.")
+    args = parser.parse_args(argv)
+
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "dimension": args.dimension,
+            "operations": args.operations,
+            "dtype": args.dtype,
+            "index": args.index,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": {},
+    }
+    context = multiprocessing.get_context("spawn")
+    for rows in args.scales:
+        print(f"Benchmarking {rows} rows...", flush=True)
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            scale = executor.submit(run_scale, rows, args.dimension, args.operations, args.dtype, args.index).result()
+        results["results"][str(rows)] = scale
+        for operation, metrics in scale.items():
+            if isinstance(metrics, dict):
+                print(f"  {operation:14} " + "  ".join(f"{metric} {value:.3f}" for metric, value in metrics.items()))
+            else:
+                print(f"  {operation:14} {metrics:.1f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for scale, operation, metric, before, after, change in regressions:
+            print(f"REGRESSION {scale} rows {operation} {metric}: {before:.3f} -> {after:.3f} ({change:+.0%})")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} against {args.baseline}")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,12 +2,44 @@ import unittest
 import numpy as np
 from vlite import VLite
 import os
-from vlite.utils import load_file
+import glob
+import tempfile
+import asyncio
+import threading
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+from vlite.utils import load_file, token_chunks, top_k_similar
+from transformers import BertTokenizerFast
+import string
+from vlite.storage import VectorBuffer, WriteAheadLog, ColumnStore, ScalarQuantizer
+from vlite.index import IVFIndex, HNSWIndex
+from vlite.cache import EmbeddingCache, DiskEmbeddingCache
+from vlite.model import EmbeddingModel
+from vlite.pool import EmbeddingPool
+from vlite.aio import AsyncVLite
+from vlite.lock import ReadWriteLock
+from vlite.sharded import ShardedVLite
+from vlite.server import VLiteServer, VLiteClient
+from vlite.metrics import Metrics
+import hashlib
 import cProfile
 from pstats import Stats
 import matplotlib.pyplot as plt
 
 
+class StubModel:
+    '''Stands in for EmbeddingModel without downloading it, embedding a text as a vector derived from its hash.'''
+    model_name = 'stub'
+    device = 'cpu'
+
+    def __init__(self, dimension=384):
+        self.dimension = dimension
+
+    def embed(self, texts, max_seq_length=256, device=None):
+        if isinstance(texts, str):
+            texts = [texts]
+        raw = b''.join(hashlib.shake_128(text.encode('utf-8')).digest(self.dimension) for text in texts)
+        return np.frombuffer(raw, dtype=np.int8).reshape(len(texts), self.dimension).astype(np.float32)
 
 class TestVLite(unittest.TestCase):
     def setUp(self):
@@ -29,18 +61,18 @@ class TestVLite(unittest.TestCase):
             "What are the novel contributions of the GPT-4 model?"
         ]
         self.corpus = load_file('test-data/gpt-4.pdf')
-        # remove test store if present
-        if os.path.exists('unittest.npz'):
-            print("[+] Removing unittest.npz")
-            os.remove('unittest.npz')
+        # remove test store and its write-ahead log if present
+        for path in glob.glob('unittest.*'):
+            print(f"[+] Removing {path}")
+            os.remove(path)
 
         self.vlite = VLite(collection='unittest.npz', DEBUG=True)
 
     def tearDown(self):
-        # remove the file
-        if os.path.exists('unittest.npz'):
-            print("[+] Removing unittest.npz")
-            os.remove('unittest.npz')
+        # remove the files
+        for path in glob.glob('unittest.*'):
+            print(f"[+] Removing {path}")
+            os.remove(path)
 
     def test_add_vector(self):
         with cProfile.Profile() as pr:
@@ -50,7 +82,23 @@ class TestVLite(unittest.TestCase):
             self.assertEqual(self.vlite.vectors.shape[0], 9) # add 4 more, s/b 9
         #stats = Stats(pr)
         #stats.strip_dirs().sort_stats("time").print_stats()
-        
+
+    def test_embed_batches_by_length(self):
+        texts = [self.queries[0] * 4, "short", self.queries[1], self.queries[12] * 2]
+        self.vlite.model.max_batch_tokens = 64
+        embeddings = self.vlite.model.embed(texts)
+        for text, embedding in zip(texts, embeddings):
+            self.assertTrue(np.allclose(embedding, self.vlite.model.embed(text)[0], atol=1e-5))
+
+    def test_chunk_fits_token_budget(self):
+        text = " ".join(self.queries) * 20
+        tokenizer = self.vlite.model.tokenizer
+        chunks = list(self.vlite.model.chunk(text, max_seq_length=32, overlap=4))
+        lengths = [len(tokenizer(chunk)['input_ids']) for chunk in chunks]
+        self.assertLessEqual(max(lengths), 32)
+        self.assertGreaterEqual(min(lengths[:-1]), 28) # only the last chunk may be short
+        self.assertTrue(text.startswith(chunks[0]) and text.endswith(chunks[-1]))
+
     def test_get_similar_vectors(self):
         with cProfile.Profile() as pr:
             self.vlite.add_vector(np.random.rand(7, 384))
@@ -88,5 +136,512 @@ class TestVLite(unittest.TestCase):
         #stats = Stats(pr)
         #stats.strip_dirs().sort_stats("time").print_stats()
 
+    def test_sharded(self):
+        texts = self.queries
+        self.vlite.memorize_many(texts, ids=range(len(texts)))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'sharded.npz')
+            db = ShardedVLite(path, shards=3)
+            db.memorize_many(texts, ids=range(len(texts)))
+            self.assertEqual(sum(shard.entry_count > 0 for shard in db.shards), 3)
+            data, _, sims = db.remember(texts[3], top_k=4)
+            expected_data, _, expected_sims = self.vlite.remember(texts[3], top_k=4)
+            self.assertEqual(data[0], texts[3])
+            self.assertTrue(np.allclose(sims, expected_sims, atol=1e-5))
+            db.forget('3')
+            self.assertEqual(db.entry_count, len(texts) - 1)
+            db.save()
+            db.close()
+            self.assertEqual(ShardedVLite(path).entry_count, len(texts) - 1)
+
+class TestPersistence(unittest.TestCase):
+    '''Tests of storage, the write-ahead log and searching, run with StubModel so they need no model download.'''
+    def setUp(self):
+        self.queries = ["What is the architecture of GPT-4?", "How many parameters does GPT-4 have?",
+                        "What are the limitations of GPT-4?", "How does GPT-4 handle longer context?",
+                        "What datasets were used to train GPT-4?", "How does the GPT-4 handle tokenization?",
+                        "What techniques were used to train GPT-4?", "What are the use cases demonstrated in the GPT-4 paper?"]
+        for path in glob.glob('unittest.*'):
+            os.remove(path)
+        self.model = StubModel()
+        self.vlite = VLite(collection='unittest.npz', model=self.model)
+
+    def tearDown(self):
+        for path in glob.glob('unittest.*'):
+            os.remove(path)
+
+    def test_add_vector_normalizes(self):
+        vectors = np.random.rand(6, 384) * 10
+        self.vlite.add_vector(vectors)
+        self.assertTrue(np.allclose(np.linalg.norm(self.vlite.vectors, axis=1), 1.0, atol=1e-5))
+        indices, sims = self.vlite.get_similar_vectors(vectors[2], top_k=1)
+        self.assertEqual(indices[0], 2)
+        self.assertAlmostEqual(sims[0], 1.0, places=5)
+
+    def test_add_integer_vectors(self):
+        vectors = np.zeros((2, 384), dtype=np.int64)
+        vectors[0, :2] = 1 # the second row stays all zero
+        self.vlite.add_vector(vectors)
+        self.assertTrue(np.allclose(np.linalg.norm(self.vlite.vectors, axis=1), [1.0, 0.0], atol=1e-5))
+        indices, sims = self.vlite.get_similar_vectors(vectors[0], top_k=2)
+        self.assertEqual(indices[0], 0)
+        self.assertAlmostEqual(sims[0], 1.0, places=5)
+        self.assertEqual(sims[1], 0.0)
+
+    def test_reopen_replays_log(self):
+        self.vlite.memorize("hello world", id="one")
+        self.vlite.memorize("goodbye world", id="two")
+        self.vlite.forget("one")
+        self.assertFalse(os.path.exists('unittest.npz')) # nothing compacted yet
+        reopened = VLite(collection='unittest.npz', model=self.model)
+        self.assertEqual(reopened._vector_key_store, ["two"])
+        self.assertEqual(reopened.vectors.shape[0], 1)
+        reopened.compact()
+        self.assertFalse(os.path.exists('unittest.wal'))
+        compacted = VLite(collection='unittest.npz', model=self.model)
+        self.assertEqual(compacted._vector_key_store, ["two"])
+        self.assertIsInstance(compacted.vectors, np.memmap)
+        self.assertEqual(compacted.remember(id="two")[0], "goodbye world")
+
+    def test_columns_share_rows(self):
+        self.vlite.memorize("hello world", id="one", metadata={"n": 1})
+        self.vlite.memorize("goodbye world", id="two", metadata={"n": 2})
+        self.vlite.save()
+        reopened = VLite(collection='unittest.npz', model=self.model)
+        self.assertIs(reopened.data._rows, reopened.metadata._rows)
+        reopened.memorize("hello again", id="one", metadata={"n": 3})
+        reopened.forget("two")
+        self.assertEqual(reopened.data._rows, {"one": 0, "two": 1}) # left as it was
+        self.assertEqual(reopened.data.keys(), ["one"])
+        self.assertEqual(reopened.metadata["one"]["n"], 3)
+        self.assertNotIn("two", reopened.metadata)
+        reopened.save()
+        self.assertEqual(VLite(collection='unittest.npz', model=self.model).remember(id="one")[0], "hello again")
+
+    def test_compacts_in_background(self):
+        db = VLite(collection='unittest.npz', model=self.model, wal_max_bytes=1)
+        db.memorize("hello world", id="one") # starts a compaction
+        db.memorize("goodbye world", id="two") # may land while the snapshot is written
+        db.forget("one")
+        db._compaction.join()
+        self.assertEqual(db.remember(id="two")[0], "goodbye world")
+        self.assertNotIn("one", db.data)
+        reopened = VLite(collection='unittest.npz', model=self.model)
+        self.assertEqual(reopened._vector_key_store, ["two"])
+        self.assertEqual(reopened.remember(id="two")[0], "goodbye world")
+
+    def test_extends_graph_in_background(self):
+        db = VLite(collection='unittest.npz', model=self.model, index='hnsw')
+        vectors = np.random.rand(300, 384) - 0.5
+        db.add_vector(vectors)
+        with db._index_lock: # rows not in the graph yet are scanned
+            self.assertEqual(db.get_similar_vectors(vectors[290], top_k=1)[0][0], 290)
+        db._graph_builder.join()
+        self.assertEqual(len(db._index), 300)
+        db.build_index()
+        self.assertEqual(len(db._index), 300)
+        self.assertEqual(db.get_similar_vectors(vectors[290], top_k=1)[0][0], 290)
+
+    def test_metadata_must_be_storable(self):
+        self.vlite.memorize("hello world", id="one", metadata={"n": np.int64(3)})
+        with self.assertRaises(ValueError):
+            self.vlite.memorize("replacement", id="one", metadata={"n": object()})
+        self.assertEqual(self.vlite.remember(id="one")[0], "hello world") # left as it was
+        reopened = VLite(collection='unittest.npz', model=self.model)
+        self.assertEqual(reopened.remember(id="one")[1]["n"], 3)
+
+    def test_forget_many(self):
+        self.vlite.max_tombstone_ratio = 0.5
+        self.vlite.memorize_many([f"text {i}" for i in range(10)], ids=range(10))
+        self.vlite.forget_many(["1", "2", "3"])
+        self.assertEqual(self.vlite.entry_count, 7)
+        self.assertEqual(self.vlite.vectors.shape[0], 10) # deleted rows are only marked
+        data, metadata, sims = self.vlite.remember("text", top_k=10)
+        self.assertEqual(len(data), 7)
+        self.assertNotIn("1", [m["id"] for m in metadata])
+        self.vlite.forget_many(["4", "5", "6"])
+        self.assertEqual(self.vlite.vectors.shape[0], 4) # purged past the tombstone ratio
+        self.assertEqual(self.vlite._vector_key_store, ["0", "7", "8", "9"])
+        self.assertEqual(self.vlite.remember(id="8")[0], "text 8")
+
+    def test_remember_many(self):
+        self.vlite.memorize_many([f"text number {i}" for i in range(20)])
+        self.vlite.forget(self.vlite._vector_key_store[3])
+        results = self.vlite.remember_many(self.queries, top_k=4, block_size=7)
+        self.assertEqual(len(results), len(self.queries))
+        for query, (data, metadata, sims) in zip(self.queries, results):
+            self.assertEqual(len(data), 4)
+            self.assertTrue(np.allclose(sims, self.vlite.remember(query, top_k=4)[2], atol=1e-5))
+
+    def test_int8_storage(self):
+        db = VLite(collection='unittest.int8.npz', model=self.model, dtype='int8', rescore=True)
+        db.memorize_many([f"text number {i}" for i in range(20)])
+        self.assertEqual(db.vectors.dtype, np.int8)
+        data, metadata, sims = db.remember("text number 3", top_k=3)
+        self.assertEqual(len(data), 3)
+        db.save()
+        quantizer = db._quantizer
+        self.assertTrue(quantizer.fitted)
+        db.memorize("more text")
+        db.save()
+        self.assertIs(db._quantizer, quantizer) # fitted once, not on every save
+        reopened = VLite(collection='unittest.int8.npz', model=self.model, rescore=True)
+        self.assertEqual(reopened.dtype, np.int8)
+        self.assertTrue(np.allclose(reopened.remember("text number 3", top_k=3)[2], sims, atol=1e-5))
+
+    def test_int8_range_is_fitted_without_rescore(self):
+        vectors = np.random.default_rng(0).normal(size=(1200, 384)).astype(np.float32)
+        bulk = VLite(collection='unittest.int8.npz', model=self.model, dtype='int8')
+        bulk.add_vector(vectors) # fitted on the first bulk insert
+        self.assertTrue(bulk._quantizer.fitted)
+        few = VLite(collection='unittest.int8few.npz', model=self.model, dtype='int8')
+        few.add_vector(vectors[:5])
+        self.assertFalse(few._quantizer.fitted)
+        few.save() # fitted on save
+        reopened = VLite(collection='unittest.int8few.npz', model=self.model)
+        self.assertTrue(reopened._quantizer.fitted)
+        similar, sims = reopened.get_similar_vectors(vectors[3], top_k=1)
+        self.assertEqual(similar[0], 3)
+        self.assertGreater(sims[0], 0.99)
+
+    def test_async_batching(self):
+        async def run():
+            async with AsyncVLite(self.vlite, max_delay=0.05) as db:
+                await asyncio.gather(*(db.memorize(f"text number {i}", id=i) for i in range(10)))
+                return await asyncio.gather(*(db.remember(query, top_k=k) for k, query in enumerate(self.queries, 1)))
+        results = asyncio.run(run())
+        self.assertEqual(self.vlite.entry_count, 10)
+        for k, (query, (data, metadata, sims)) in enumerate(zip(self.queries, results), 1):
+            self.assertEqual(len(data), min(k, 10))
+            self.assertTrue(np.allclose(sims, self.vlite.remember(query, top_k=k)[2], atol=1e-5))
+
+    def test_concurrent_reads_and_writes(self):
+        def write(i):
+            self.vlite.memorize(f"text number {i}", id=i)
+            if i % 3 == 0:
+                self.vlite.forget(i)
+        def read(query):
+            data, metadata, sims = self.vlite.remember(query, top_k=3)
+            self.assertEqual(len(data), len(metadata))
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [executor.submit(write, i) for i in range(30)]
+            futures += [executor.submit(read, query) for query in self.queries * 2]
+            for future in futures:
+                future.result()
+        self.assertEqual(self.vlite.entry_count, 20)
+        self.assertEqual(len(self.vlite._key_index), 20)
+
+    def test_where_filter(self):
+        db = VLite(collection='unittest.where.npz', model=self.model, indexed_fields=["tenant", "date"])
+        db.memorize_many([f"text number {i}" for i in range(20)], ids=range(20),
+                         metadata=[{"tenant": "a" if i % 2 else "b", "date": 2000 + i} for i in range(20)])
+        data, metadata, sims = db.remember("text", top_k=20, where={"tenant": "a"})
+        self.assertEqual(len(data), 10)
+        self.assertTrue(all(m["tenant"] == "a" for m in metadata))
+        data, metadata, sims = db.remember("text", top_k=20, where={"tenant": {"$in": ["a", "b"]}, "date": {"$gte": 2005, "$lt": 2010}})
+        self.assertEqual(sorted(m["date"] for m in metadata), list(range(2005, 2010)))
+        db.forget_many(range(5, 8))
+        db.save()
+        reopened = VLite(collection='unittest.where.npz', model=self.model, indexed_fields=["tenant", "date"])
+        self.assertIsNone(reopened._metadata_index) # built on the first filtered search
+        data, metadata, sims = reopened.remember("text", top_k=20, where={"date": {"$gte": 2005, "$lt": 2010}})
+        self.assertEqual(sorted(m["date"] for m in metadata), [2008, 2009])
+        with self.assertRaises(ValueError):
+            reopened.remember("text", where={"source": "web"})
+
+    def test_ingest(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'notes.txt')
+            with open(path, 'w') as f:
+                f.write("\n\n".join(f"paragraph {i} about something" for i in range(30)))
+            pages = (f"page {i}" for i in range(3))
+            count = self.vlite.ingest([path, pages], chunker=lambda page: page.split("\n\n"), batch_size=8, checkpoint_every=16)
+        self.assertEqual(count, 33)
+        self.assertEqual(self.vlite.entry_count, 33)
+        self.assertFalse(os.path.exists('unittest.wal')) # saved at the end
+        data, metadata, sims = self.vlite.remember("page 1", top_k=33)
+        self.assertEqual(sorted(m["page"] for m in metadata if m["source"] is None), [0, 1, 2])
+
+    def test_memorize_many_copies_metadata(self):
+        shared = {"tag": "x"}
+        self.vlite.memorize_many(["a", "b", "c"], ids=["one", "two", "three"], metadata=[shared] * 3)
+        self.assertEqual(shared, {"tag": "x"})
+        self.assertEqual([self.vlite.metadata[id]["id"] for id in ["one", "two", "three"]], ["one", "two", "three"])
+
+    def test_ingest_checks_embedder(self):
+        with self.assertRaises(ValueError):
+            self.vlite.ingest([["some text"]], embedder=StubModel(dimension=8))
+        with self.assertRaises(ValueError):
+            self.vlite._add_embedded(["some text"], ["one"], [None], np.zeros((1, 8), dtype=np.float32))
+        self.assertFalse(os.path.exists('unittest.wal')) # nothing logged that would not replay
+        self.assertEqual(VLite(collection='unittest.npz', model=self.model).entry_count, 0)
+
+    def test_server(self):
+        server = VLiteServer(self.vlite, port=0)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            def query(i):
+                with VLiteClient(port=server.address[1]) as client:
+                    return client.remember(self.queries[i], top_k=1)[0][0]
+            with VLiteClient(port=server.address[1]) as client:
+                ids = client.memorize_many(self.queries)
+                self.assertEqual(client.memorize("extra", id="x"), "x")
+                self.assertEqual(client.remember(id="x")[0], "extra")
+                with ThreadPoolExecutor(max_workers=8) as executor:
+                    expected = [self.vlite.remember(text, top_k=1)[0][0] for text in self.queries[:8]]
+                    self.assertEqual(list(executor.map(query, range(8))), expected)
+                client.forget_many(ids)
+                self.assertEqual(client.health()["entries"], 1)
+                with self.assertRaises(KeyError):
+                    client.forget("missing")
+        finally:
+            server.shutdown()
+            thread.join()
+
+    def test_client_does_not_resend_writes(self):
+        paths = []
+        class LosesWriteResponses(socketserver.StreamRequestHandler):
+            def handle(self):
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    headers = {}
+                    while (header := self.rfile.readline().strip()):
+                        name, value = header.decode().split(":", 1)
+                        headers[name.lower()] = value.strip()
+                    self.rfile.read(int(headers.get("content-length", 0)))
+                    paths.append(line.split()[1].decode())
+                    if not line.startswith(b"GET"):
+                        return # handled, but the connection breaks before the response
+                    body = b'{"entries": 0}'
+                    self.wfile.write(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+        server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), LosesWriteResponses)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            with VLiteClient(port=server.server_address[1]) as client:
+                client.health() # the memorize below reuses this connection
+                with self.assertRaises(ConnectionError):
+                    client.memorize("hello world")
+                self.assertEqual(client.health()["entries"], 0)
+            self.assertEqual(paths, ["/health", "/memorize", "/health"])
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def test_metrics(self):
+        events = []
+        metrics = Metrics([lambda kind, name, value: events.append((kind, name))])
+        db = VLite(collection='unittest.metrics.npz', model=self.model, metrics=metrics)
+        db.memorize_many(self.queries)
+        db.remember(self.queries[0])
+        db.remember(self.queries[0])
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["counters"]["cache.memory.hits"], 2) # embedded by memorize_many
+        self.assertEqual(snapshot["counters"]["search.rows_scanned"], 2 * len(self.queries))
+        for stage in ("search.similarity", "search.top_k", "remember.lookup", "memorize_many"):
+            self.assertIn(stage, snapshot["timers"])
+        self.assertEqual(snapshot["timers"]["remember"]["count"], 2)
+        self.assertIn(("timer", "remember"), events)
+
+class TestEmbeddingCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = EmbeddingCache(max_entries=2)
+        keys = [EmbeddingCache.key('model', 256, text) for text in ("a", "b", "c")]
+        cache.put(keys[0], np.zeros(4))
+        cache.put(keys[1], np.ones(4))
+        self.assertIsNotNone(cache.get(keys[0])) # a is now the most recently used
+        cache.put(keys[2], np.ones(4))
+        self.assertIsNone(cache.get(keys[1]))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.nbytes, 2 * 4 * 4)
+
+class TestDiskEmbeddingCache(unittest.TestCase):
+    def test_persist_and_evict(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'embeddings')
+            keys = [EmbeddingCache.key('model', 256, f"text {i}") for i in range(10)]
+            cache = DiskEmbeddingCache(path, 4, max_bytes=8 * 16)
+            for i, key in enumerate(keys[:8]):
+                cache.put(key, np.full(4, i))
+            self.assertEqual(cache.get(keys[0])[0], 0) # keeps text 0 on eviction
+            cache.put(keys[8], np.full(4, 8))
+            cache.close()
+
+            reopened = DiskEmbeddingCache(path, 4, max_bytes=8 * 16)
+            self.assertEqual(len(reopened), 7)
+            self.assertEqual(reopened.get(keys[0])[0], 0)
+            self.assertEqual(reopened.get(keys[8])[0], 8)
+            self.assertIsNone(reopened.get(keys[1]))
+
+class TestEmbeddingPool(unittest.TestCase):
+    def test_embed_in_order(self):
+        texts = [f"text number {i} " * (i % 5 + 1) for i in range(50)]
+        with EmbeddingPool(processes=2, batch_size=8) as pool:
+            embeddings = pool.embed(texts)
+        self.assertTrue(np.allclose(embeddings, EmbeddingModel().embed(texts), atol=1e-5))
+
+class TestReadWriteLock(unittest.TestCase):
+    def test_writer_excludes_readers(self):
+        lock = ReadWriteLock()
+        events = []
+        def write():
+            with lock.write():
+                events.append("write")
+        with lock.read():
+            writer = threading.Thread(target=write)
+            with lock.read(): # reentrant even though a writer is waiting
+                writer.start()
+                writer.join(timeout=0.1)
+            self.assertEqual(events, [])
+        writer.join(timeout=1)
+        self.assertEqual(events, ["write"])
+
+class TestTokenChunks(unittest.TestCase):
+    def setUp(self):
+        # One token per letter, so words can be made as long as needed
+        self.directory = tempfile.TemporaryDirectory()
+        vocab = os.path.join(self.directory.name, 'vocab.txt')
+        with open(vocab, 'w') as f:
+            f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + list(string.ascii_lowercase)
+                              + ["##" + c for c in string.ascii_lowercase]))
+        self.tokenizer = BertTokenizerFast(vocab)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_word_longer_than_budget(self):
+        text = "hi " + "abcdefghi" * 10 + " there" # a 90 token word
+        for overlap in (0, 4):
+            chunks = list(token_chunks(text, self.tokenizer, max_tokens=32, overlap=overlap))
+            self.assertEqual(len(chunks), 5)
+            self.assertEqual(chunks[0], "hi")
+            self.assertTrue(all(len(self.tokenizer(chunk)['input_ids']) <= 32 for chunk in chunks))
+
+class TestVectorBuffer(unittest.TestCase):
+    def test_append_grows_capacity(self):
+        buffer = VectorBuffer(384)
+        for i in range(100):
+            buffer.append(np.full(384, i, dtype=np.float64))
+        self.assertEqual(buffer.array.shape, (100, 384))
+        self.assertTrue(buffer.capacity >= 100)
+        self.assertTrue(buffer.array.flags['C_CONTIGUOUS'])
+        self.assertEqual(buffer.array[42, 0], 42)
+
+    def test_delete(self):
+        buffer = VectorBuffer.from_array(np.arange(10, dtype=np.float64).reshape(5, 2))
+        buffer.delete(1)
+        self.assertEqual(buffer.array[:, 0].tolist(), [0, 4, 6, 8])
+        buffer.append(np.ones((2, 2)))
+        self.assertEqual(len(buffer), 6)
+
+class TestWriteAheadLog(unittest.TestCase):
+    def test_replay_drops_torn_tail(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.wal')
+            wal = WriteAheadLog(path, fsync=False)
+            wal.append_insert(["a"], ["text"], [{"id": "a"}], np.ones((1, 4), dtype=np.float32))
+            wal.append_delete(["a"])
+            wal.close()
+            size = wal.size
+            with open(path, 'ab') as f:
+                f.write(b'\x10\x00\x00') # partial header from an interrupted append
+            records = list(WriteAheadLog(path).replay())
+            self.assertEqual([r["op"] for r in records], ["insert", "delete"])
+            self.assertEqual(records[0]["vectors"].shape, (1, 4))
+            self.assertEqual(os.path.getsize(path), size)
+
+    def test_rotate_appends_to_earlier_records(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.wal')
+            pending = os.path.join(directory, 'test.1.wal')
+            wal = WriteAheadLog(path, fsync=False)
+            wal.append_delete(["a"])
+            wal.rotate(pending)
+            wal.append_delete(["b"])
+            wal.rotate(pending) # e.g. after a failed compaction
+            self.assertEqual(wal.size, 0)
+            wal.append_delete(["c"])
+            self.assertEqual([r["ids"] for r in WriteAheadLog(pending).replay()], [["a"], ["b"]])
+            self.assertEqual([r["ids"] for r in wal.replay()], [["c"]])
+            wal.close()
+
+class TestColumnStore(unittest.TestCase):
+    def test_write_and_read(self):
+        values = ["first", {"id": "b", "tags": [1, 2]}, ["page one", "page two"], ""]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'column')
+            ColumnStore.write(path, (ColumnStore.encode(value) for value in values))
+            store = ColumnStore(path)
+            self.assertEqual(len(store), 4)
+            self.assertEqual([store[row] for row in range(4)], values)
+            self.assertEqual(store.raw(1), ColumnStore.encode(values[1]))
+
+class TestScalarQuantizer(unittest.TestCase):
+    def test_round_trip(self):
+        vectors = np.random.rand(100, 384).astype(np.float32) * 2 - 1
+        quantizer = ScalarQuantizer.fit(vectors)
+        codes = quantizer.encode(vectors)
+        self.assertEqual(codes.dtype, np.int8)
+        self.assertTrue(np.abs(quantizer.decode(codes) - vectors).max() <= quantizer.scale.max())
+
+    def test_scores_codes_without_decoding(self):
+        vectors = np.random.rand(10000, 384).astype(np.float32) * 2 - 1
+        queries = np.random.rand(3, 384).astype(np.float32) * 2 - 1
+        quantizer = ScalarQuantizer.fit(vectors)
+        codes = quantizer.encode(vectors)
+        for normalized in (True, False):
+            idx, sims = top_k_similar(queries, codes, 5, quantizer=quantizer, normalized=normalized)
+            decoded_idx, decoded_sims = top_k_similar(queries, codes, 5, decode=quantizer.decode, normalized=normalized)
+            self.assertEqual(idx.tolist(), decoded_idx.tolist())
+            self.assertTrue(np.allclose(sims, decoded_sims, atol=1e-4))
+
+class TestIVFIndex(unittest.TestCase):
+    def test_search_rows(self):
+        vectors = np.random.rand(2000, 384).astype(np.float32) - 0.5
+        index = IVFIndex(n_lists=16, nprobe=4)
+        index.train(vectors)
+        index.add(vectors, np.arange(2000))
+        self.assertEqual(len(index), 2000)
+        rows = index.search_rows(vectors[7], nprobe=4)
+        self.assertIn(7, rows)
+        self.assertEqual(sorted(index.search_rows(vectors[7], nprobe=16)), list(range(2000)))
+        # More lists are searched until top_k rows are found, also when most rows are excluded
+        exclude = np.ones(2000, dtype=bool)
+        exclude[::10] = False
+        self.assertGreaterEqual(len(index.search_rows(vectors[7], nprobe=1, top_k=150, exclude=exclude)), 150)
+
+        new_rows = np.arange(2000) - 1 # drop row 0
+        index.remap(new_rows)
+        self.assertEqual(len(index), 1999)
+        restored = IVFIndex()
+        restored.load_state(index.state())
+        self.assertIn(6, restored.search_rows(vectors[7], nprobe=4))
+
+class TestHNSWIndex(unittest.TestCase):
+    def test_search_rows(self):
+        vectors = np.random.rand(500, 384).astype(np.float32) - 0.5
+        index = HNSWIndex(M=8, ef_construction=64)
+        index.attach(lambda rows: vectors[rows])
+        index.add(vectors, np.arange(500))
+        self.assertEqual(len(index), 500)
+        self.assertEqual(index.search_rows(vectors[42], top_k=1)[0], 42)
+
+        exclude = np.zeros(500, dtype=bool)
+        exclude[42] = True
+        self.assertNotIn(42, index.search_rows(vectors[42], top_k=5, exclude=exclude))
+
+        new_rows = np.arange(500) - 1 # drop row 0
+        index.remap(new_rows)
+        self.assertEqual(len(index), 499)
+        restored = HNSWIndex()
+        restored.attach(lambda rows: vectors[np.asarray(rows) + 1])
+        restored.load_state(index.state())
+        self.assertEqual(restored.search_rows(vectors[42], top_k=1)[0], 41)
+
 if __name__ == '__main__':
     unittest.main()
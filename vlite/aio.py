@@ -0,0 +1,152 @@
+import asyncio
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Tuple
+from .main import VLite
+
+
+class _Batcher:
+    '''
+    _Batcher collects requests arriving within a short window and runs them as one call in an executor.
+
+    A batch is started once `max_batch_size` requests are waiting or `max_delay` seconds after
+    its first request arrived, whichever comes first. `run` receives the list of requests and
+    returns one result per request, or an exception for a request that failed on its own.
+    '''
+    def __init__(self, run:Callable[[list], list], executor, max_batch_size:int, max_delay:float):
+        self._run = run
+        self._executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self._pending = []
+        self._timer = None
+        self._running = set()
+
+    def submit(self, request) -> asyncio.Future:
+        """Queue a request and return a future for its result."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((request, future))
+        if len(self._pending) >= self.max_batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self.flush)
+        return future
+
+    def flush(self):
+        """Start running the waiting requests now."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = asyncio.get_running_loop().run_in_executor(self._executor, self._run, [request for request, _ in batch])
+        self._running.add(task)
+        task.add_done_callback(lambda task: self._resolve(batch, task))
+
+    def _resolve(self, batch:list, task:asyncio.Future):
+        self._running.discard(task)
+        if task.cancelled():
+            for _, future in batch:
+                future.cancel()
+            return
+        error = task.exception()
+        results = [None] * len(batch) if error is not None else task.result()
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            elif isinstance(result, BaseException):
+                # The request failed on its own, the rest of the batch did not
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def drain(self):
+        """Run the waiting requests and wait until every started batch finished."""
+        self.flush()
+        while self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+
+
+class AsyncVLite:
+    '''
+    AsyncVLite is an asyncio front-end for a VLite database.
+
+    Calls never block the event loop: the work runs in an executor. Concurrent remember
+    calls arriving within `max_delay` seconds of each other are embedded and searched
+    together with one remember_many call, and concurrent memorize calls are added with one
+    memorize_many call, then every caller gets its own result back.
+
+    By default all work runs on a single thread, so batches run in the order they were
+    formed. VLite is thread-safe, so an executor with several threads lets searches run
+    in parallel.
+    '''
+    def __init__(self, db:VLite, max_batch_size:int=64, max_delay:float=0.005, executor=None):
+        """
+        Wrap a database.
+
+        Parameters:
+        db (VLite): The database to serve.
+        max_batch_size (int): The maximum number of requests combined into one call.
+        max_delay (float): The number of seconds a request waits for others to batch with.
+        executor (concurrent.futures.Executor): Runs the database calls. Defaults to a single thread owned by this object.
+        """
+        self.db = db
+        self._owns_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix="vlite")
+        self._remember = _Batcher(self._remember_many, self._executor, max_batch_size, max_delay)
+        self._memorize = _Batcher(self._memorize_many, self._executor, max_batch_size, max_delay)
+
+    async def remember(self, text:str=None, id:Any=None, top_k:int=5) -> Tuple[List[Any], List[Any], Any]:
+        """Retrieve a text from the database by id or by text, see VLite.remember."""
+        if id is not None:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, lambda: self.db.remember(id=id))
+        return await self._remember.submit((text, top_k))
+
+    async def memorize(self, text:str, id:Any=None, metadata:Any=None) -> Tuple[str, Any]:
+        """Add a text to the database, see VLite.memorize."""
+        return await self._memorize.submit((text, str(id) if id is not None else str(uuid.uuid4()), metadata))
+
+    def _remember_many(self, requests:list) -> list:
+        top_k = max(top_k for _, top_k in requests)
+        results = self.db.remember_many([text for text, _ in requests], top_k=top_k)
+        # Results are sorted best first, so a smaller top_k is a prefix of the shared one
+        return [(data[:k], metadata[:k], sims[:k]) for (_, k), (data, metadata, sims) in zip(requests, results)]
+
+    def _memorize_many(self, requests:list) -> list:
+        # memorize_many needs unique ids, so a repeated id starts a new call and the last write still wins
+        results = []
+        start = 0
+        while start < len(requests):
+            end, seen = start, set()
+            while end < len(requests) and requests[end][1] not in seen:
+                seen.add(requests[end][1])
+                end += 1
+            texts, ids, metadata = zip(*requests[start:end])
+            try:
+                results.extend(zip(*self.db.memorize_many(list(texts), ids=list(ids), metadata=list(metadata))))
+            except ValueError:
+                # Nothing was added, so add the requests one by one to fail only the bad ones
+                for text, id, meta in requests[start:end]:
+                    try:
+                        results.append(self.db.memorize(text, id=id, metadata=meta))
+                    except ValueError as e:
+                        results.append(e)
+            start = end
+        return results
+
+    async def close(self):
+        """Finish every waiting request and release the executor."""
+        await self._remember.drain()
+        await self._memorize.drain()
+        if self._owns_executor:
+            self._executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
@@ -0,0 +1,230 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class EmbeddingCache:
+    '''
+    EmbeddingCache is a bounded in-memory LRU cache of text embeddings.
+
+    Entries are keyed by model name, max sequence length and a digest of the text, so
+    one cache can be shared by databases using different models. The least recently
+    used entries are evicted once either `max_entries` or `max_bytes` is exceeded.
+    '''
+    def __init__(self, max_entries:int=4096, max_bytes:int=32 * 1024 * 1024):
+        """
+        Initialize an empty cache.
+
+        Parameters:
+        max_entries (int): The maximum number of embeddings kept.
+        max_bytes (int): The maximum number of bytes of embedding data kept.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model_name:str, max_seq_length:int, text:str) -> tuple:
+        """The cache key of a text embedded by a model."""
+        return (model_name, max_seq_length, hashlib.sha1(text.encode("utf-8")).digest())
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self):
+        """The number of bytes of embedding data currently kept."""
+        return self._bytes
+
+    def get(self, key:tuple):
+        """Return the cached embedding for `key` and mark it as recently used, or None on a miss."""
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def put(self, key:tuple, vector):
+        """Store an embedding, evicting the least recently used entries if the cache is full."""
+        vector = np.array(vector, dtype=np.float32)
+        vector.flags.writeable = False
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous.nbytes
+            self._entries[key] = vector
+            self._bytes += vector.nbytes
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+
+    def clear(self):
+        """Drop every entry and reset the hit and miss counters."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+
+class DiskEmbeddingCache:
+    '''
+    DiskEmbeddingCache is a persistent embedding cache, so texts that were already embedded are not embedded again when a collection is rebuilt.
+
+    Embeddings are appended to a raw float32 file that is read through a memory map, and
+    the digest of every entry's key is appended to a second file in the same order, so
+    adding entries never rewrites existing data. Once the vector file grows past
+    `max_bytes`, the least recently used entries are dropped by rewriting both files.
+    '''
+    _DIGEST_SIZE = 20
+
+    def __init__(self, path:str, dimension:int, max_bytes:int=1024 * 1024 * 1024):
+        """
+        Open a cache, creating it on the first put.
+
+        Parameters:
+        path (str): The filename prefix of the cache. Uses `<path>.vectors`, `<path>.keys` and `<path>.json`.
+        dimension (int): The dimension of the cached embeddings.
+        max_bytes (int): The maximum size of the vector file in bytes.
+        """
+        self.path = path
+        self.dimension = dimension
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._files = None
+
+        if os.path.exists(f"{path}.json"):
+            with open(f"{path}.json") as f:
+                saved = json.load(f)["dimension"]
+            if saved != dimension:
+                raise ValueError(f"Cache {path} holds embeddings of dimension {saved}, not {dimension}.")
+        row_bytes = 4 * dimension
+        try:
+            with open(f"{path}.keys", 'rb') as f:
+                digests = f.read()
+            rows = min(len(digests) // self._DIGEST_SIZE, os.path.getsize(f"{path}.vectors") // row_bytes)
+        except FileNotFoundError:
+            digests, rows = b"", 0
+        # Drop a partially written entry left behind by an interrupted put
+        for suffix, size in (("keys", rows * self._DIGEST_SIZE), ("vectors", rows * row_bytes)):
+            if os.path.exists(f"{path}.{suffix}") and os.path.getsize(f"{path}.{suffix}") != size:
+                with open(f"{path}.{suffix}", 'r+b') as f:
+                    f.truncate(size)
+        size = self._DIGEST_SIZE
+        self._rows = {digests[row * size:(row + 1) * size]: row for row in range(rows)}
+        # Recency of every row, in insertion order until entries are used
+        self._last_used = list(range(rows))
+        self._clock = rows
+
+    @staticmethod
+    def digest(key:tuple) -> bytes:
+        """The digest a key of EmbeddingCache.key is stored under."""
+        model_name, max_seq_length, text_digest = key
+        return hashlib.sha1(f"{model_name}\0{max_seq_length}\0".encode("utf-8") + text_digest).digest()
+
+    def __len__(self):
+        return len(self._rows)
+
+    @property
+    def nbytes(self):
+        """The size of the vector file in bytes."""
+        return len(self._rows) * 4 * self.dimension
+
+    def _tick(self, row:int):
+        self._last_used[row] = self._clock
+        self._clock += 1
+
+    def get(self, key:tuple):
+        """Return the cached embedding for `key`, or None on a miss."""
+        digest = self.digest(key)
+        with self._lock:
+            row = self._rows.get(digest)
+            if row is None:
+                self.misses += 1
+                return None
+            if self._vectors is None or row >= len(self._vectors):
+                self._flush()
+                self._vectors = np.memmap(f"{self.path}.vectors", dtype=np.float32, mode='r', shape=(len(self._rows), self.dimension))
+            self._tick(row)
+            self.hits += 1
+            return np.array(self._vectors[row])
+
+    def put(self, key:tuple, vector):
+        """Append an embedding, dropping the least recently used entries if the cache outgrew `max_bytes`."""
+        digest = self.digest(key)
+        vector = np.ascontiguousarray(vector, dtype=np.float32).reshape(self.dimension)
+        with self._lock:
+            if digest in self._rows:
+                return
+            if self._files is None:
+                if not os.path.exists(f"{self.path}.json"):
+                    with open(f"{self.path}.json", 'w') as f:
+                        json.dump({"dimension": self.dimension}, f)
+                self._files = (open(f"{self.path}.vectors", 'ab'), open(f"{self.path}.keys", 'ab'))
+            # Vectors are written before their key, so a key always has a complete vector
+            self._files[0].write(vector.tobytes())
+            self._files[1].write(digest)
+            row = len(self._rows)
+            self._rows[digest] = row
+            self._last_used.append(0)
+            self._tick(row)
+            if self.nbytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Rewrite the cache keeping the most recently used entries, down to 90% of `max_bytes`."""
+        self._flush()
+        self._close()
+        keep = max(int(0.9 * self.max_bytes) // (4 * self.dimension), 0)
+        rows = np.argsort(self._last_used, kind='stable')[max(len(self._last_used) - keep, 0):]
+        digests = sorted(self._rows, key=self._rows.get)
+        vectors = np.memmap(f"{self.path}.vectors", dtype=np.float32, mode='r', shape=(len(self._rows), self.dimension))
+        with open(f"{self.path}.vectors.tmp", 'wb') as f:
+            for start in range(0, len(rows), 65536):
+                f.write(np.ascontiguousarray(vectors[rows[start:start + 65536]]).tobytes())
+        with open(f"{self.path}.keys.tmp", 'wb') as f:
+            f.write(b"".join(digests[row] for row in rows))
+        del vectors
+        # Without a key file the cache opens empty, so a crash in between never pairs keys with the wrong vectors
+        os.remove(f"{self.path}.keys")
+        os.replace(f"{self.path}.vectors.tmp", f"{self.path}.vectors")
+        os.replace(f"{self.path}.keys.tmp", f"{self.path}.keys")
+        self._rows = {digests[row]: new for new, row in enumerate(rows)}
+        self._last_used = list(range(len(rows)))
+        self._clock = len(rows)
+
+    def _flush(self):
+        if self._files is not None:
+            for f in self._files:
+                f.flush()
+
+    def _close(self):
+        self._vectors = None
+        if self._files is not None:
+            for f in self._files:
+                f.close()
+            self._files = None
+
+    def flush(self):
+        """Write buffered entries to disk."""
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        """Write buffered entries to disk and close the files."""
+        with self._lock:
+            self._flush()
+            self._close()
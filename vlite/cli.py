@@ -0,0 +1,49 @@
+import argparse
+import signal
+import threading
+from .main import VLite
+from .server import VLiteServer
+
+
+def serve(args):
+    """Load a collection and serve it until interrupted, saving it on the way out."""
+    db = VLite(collection=args.collection, model_name=args.model, device=args.device, index=args.index,
+               indexed_fields=args.indexed_fields, DEBUG=args.debug)
+    server = VLiteServer(db, host=args.host, port=args.port, unix_socket=args.socket,
+                         max_batch_size=args.max_batch_size, max_delay=args.max_delay)
+    # serve_forever blocks the main thread, so a signal stops it from another thread
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.httpd.shutdown).start())
+    print(f"Serving {args.collection} ({db.entry_count} entries) on {server.address}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        db.save()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="vlite", description="vlite vector database")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parser_serve = commands.add_parser("serve", help="Serve a collection over HTTP, keeping the model loaded.")
+    parser_serve.add_argument("collection", help="The collection file to serve, created if it does not exist.")
+    parser_serve.add_argument("--host", default="127.0.0.1", help="The address to listen on.")
+    parser_serve.add_argument("--port", type=int, default=8765, help="The TCP port to listen on.")
+    parser_serve.add_argument("--socket", default=None, help="Listen on this Unix socket path instead of a TCP port.")
+    parser_serve.add_argument("--model", default=None, help="The name of the embedding model.")
+    parser_serve.add_argument("--device", default=None, help="The device to run the model on.")
+    parser_serve.add_argument("--index", default=None, choices=["ivf", "hnsw"], help="The approximate search index to use.")
+    parser_serve.add_argument("--indexed-fields", nargs="+", default=None, help="Metadata fields to index for filtering.")
+    parser_serve.add_argument("--max-batch-size", type=int, default=64, help="The maximum number of requests batched together.")
+    parser_serve.add_argument("--max-delay", type=float, default=0.005, help="The seconds a request waits for others to batch with.")
+    parser_serve.add_argument("--debug", action="store_true", help="Log every request.")
+    parser_serve.set_defaults(run=serve)
+
+    args = parser.parse_args(argv)
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
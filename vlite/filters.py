@@ -0,0 +1,140 @@
+import numpy as np
+
+_RANGE_OPERATORS = ("$gt", "$gte", "$lt", "$lte")
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class MetadataIndex:
+    '''
+    MetadataIndex maps values of selected metadata fields to the rows holding them.
+
+    Every field has an inverted index from value to rows for equality and `$in` filters,
+    and a sorted array of its numeric values for range filters, which is rebuilt on the
+    first range query after a change. A list value is indexed under each of its items.
+
+    Filters are dicts of field to condition, all of which must hold:
+
+        {"tenant": "acme"}                          # equality
+        {"source": {"$in": ["web", "pdf"]}}         # any of several values
+        {"date": {"$gte": 20230101, "$lt": 20240101}}  # numeric range
+    '''
+    def __init__(self, fields:list):
+        """
+        Initialize an empty index.
+
+        Parameters:
+        fields (list): The metadata fields to index.
+        """
+        self.fields = list(fields)
+        self._values = {field: {} for field in self.fields}
+        self._inverted = {field: {} for field in self.fields}
+        self._sorted = {}
+
+    def _items(self, value) -> list:
+        items = value if isinstance(value, (list, tuple)) else [value]
+        return [item for item in items if item is None or isinstance(item, (str, int, float, bool))]
+
+    def add(self, row:int, metadata):
+        """Index the metadata of a row."""
+        if not isinstance(metadata, dict):
+            return
+        for field in self.fields:
+            if field not in metadata:
+                continue
+            items = self._items(metadata[field])
+            self._values[field][row] = items
+            for item in items:
+                self._inverted[field].setdefault(item, set()).add(row)
+            self._sorted.pop(field, None)
+
+    def remove(self, row:int):
+        """Drop a row from the index."""
+        for field in self.fields:
+            items = self._values[field].pop(row, None)
+            if items is None:
+                continue
+            for item in items:
+                rows = self._inverted[field][item]
+                rows.discard(row)
+                if not rows:
+                    del self._inverted[field][item]
+            self._sorted.pop(field, None)
+
+    def remap(self, new_rows:np.ndarray):
+        """Renumber rows after rows were removed from the vector store. `new_rows[row]` is the new row, or -1 if it was removed."""
+        values = self._values
+        self._values = {field: {} for field in self.fields}
+        self._inverted = {field: {} for field in self.fields}
+        self._sorted = {}
+        for field in self.fields:
+            for row, items in values[field].items():
+                if new_rows[row] >= 0:
+                    row = int(new_rows[row])
+                    self._values[field][row] = items
+                    for item in items:
+                        self._inverted[field].setdefault(item, set()).add(row)
+
+    def _numeric(self, field:str):
+        """The numeric values of a field and their rows, sorted by value."""
+        result = self._sorted.get(field)
+        if result is None:
+            pairs = [(item, row) for row, items in self._values[field].items() for item in items if _is_number(item)]
+            values = np.array([value for value, _ in pairs], dtype=np.float64)
+            rows = np.array([row for _, row in pairs], dtype=np.int64)
+            order = np.argsort(values, kind='stable')
+            result = (values[order], rows[order])
+            self._sorted[field] = result
+        return result
+
+    def _rows_of(self, field:str, items) -> np.ndarray:
+        rows = set()
+        for item in items:
+            rows |= self._inverted[field].get(item, set())
+        return np.fromiter(rows, dtype=np.int64, count=len(rows))
+
+    def rows(self, where:dict) -> np.ndarray:
+        """
+        Find the rows matching a filter.
+
+        Parameters:
+        where (dict): The filter, see the class documentation.
+
+        Returns:
+        rows (np.ndarray): The sorted rows matching every condition.
+        """
+        result = None
+        for field, condition in where.items():
+            if field not in self._values:
+                raise ValueError(f"Cannot filter on '{field}', it is not one of the indexed metadata fields {self.fields}.")
+            if not isinstance(condition, dict):
+                condition = {"$eq": condition}
+            matched = []
+            for operator, operand in condition.items():
+                if operator == "$eq":
+                    matched.append(self._rows_of(field, [operand]))
+                elif operator == "$in":
+                    matched.append(self._rows_of(field, operand))
+                elif operator not in _RANGE_OPERATORS:
+                    raise ValueError(f"Unknown filter operator '{operator}'.")
+            bounds = {operator: operand for operator, operand in condition.items() if operator in _RANGE_OPERATORS}
+            if bounds:
+                values, rows = self._numeric(field)
+                start, stop = 0, len(values)
+                if "$gt" in bounds:
+                    start = max(start, np.searchsorted(values, bounds["$gt"], side='right'))
+                if "$gte" in bounds:
+                    start = max(start, np.searchsorted(values, bounds["$gte"], side='left'))
+                if "$lt" in bounds:
+                    stop = min(stop, np.searchsorted(values, bounds["$lt"], side='left'))
+                if "$lte" in bounds:
+                    stop = min(stop, np.searchsorted(values, bounds["$lte"], side='right'))
+                matched.append(rows[start:max(start, stop)])
+            for rows in matched:
+                rows = np.unique(rows)
+                result = rows if result is None else np.intersect1d(result, rows, assume_unique=True)
+        if result is None:
+            raise ValueError("'where' must contain at least one condition.")
+        return result
@@ -0,0 +1,546 @@
+import heapq
+import numpy as np
+from .utils import normalize
+
+
+def kmeans(vectors, n_clusters:int, iterations:int=10, seed:int=0, block_size:int=65536):
+    """
+    Cluster vectors by cosine similarity (spherical k-means).
+
+    Args:
+    vectors: 2D array of vectors to cluster
+    n_clusters: number of centroids
+    iterations: number of Lloyd iterations
+    seed: seed for the initial centroid sample
+    block_size: number of vectors assigned per matrix multiply
+
+    Returns:
+    unit-norm centroids of shape (n_clusters, dimension)
+    """
+    vectors = normalize(np.asarray(vectors, dtype=np.float32))
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)]
+    for _ in range(iterations):
+        assignments = assign(vectors, centroids, block_size=block_size)
+        order = np.argsort(assignments, kind='stable')
+        clusters, starts = np.unique(assignments[order], return_index=True)
+        sums = np.zeros_like(centroids)
+        sums[clusters] = np.add.reduceat(vectors[order], starts, axis=0)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        # Reseed empty clusters with random vectors so every list stays in use
+        empty = counts == 0
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        centroids = normalize(sums)
+    return centroids
+
+
+def assign(vectors, centroids, block_size:int=65536):
+    """Return the index of the most similar centroid for every vector."""
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        assignments[start:start + block_size] = np.argmax(vectors[start:start + block_size] @ centroids.T, axis=1)
+    return assignments
+
+
+class IVFIndex:
+    '''
+    IVFIndex is an inverted file index: vectors are clustered with k-means and each cluster
+    keeps the rows assigned to it. A search only scores the rows of the `nprobe` clusters
+    whose centroids are most similar to the query.
+    '''
+    requires_training = True
+
+    def __init__(self, n_lists:int=None, nprobe:int=8, iterations:int=10, max_train_rows:int=256):
+        """
+        Initialize an untrained index.
+
+        Parameters:
+        n_lists (int): The number of clusters. Defaults to 4 * sqrt(number of training rows).
+        nprobe (int): The default number of clusters to search per query.
+        iterations (int): The number of k-means iterations used for training.
+        max_train_rows (int): Train on at most this many rows per cluster, sampled at random.
+        """
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.iterations = iterations
+        self.max_train_rows = max_train_rows
+        self.centroids = None
+        self._lists = []
+        self.trained_rows = 0
+
+    @property
+    def is_trained(self):
+        """Whether the index has centroids and can be searched."""
+        return self.centroids is not None
+
+    def train(self, vectors, decode=None):
+        """
+        Fit the centroids to a sample of `vectors` and empty every list. Rows are added with `add`.
+
+        Parameters:
+        vectors (np.ndarray): The vectors to train on.
+        decode (Callable): Optional function turning stored vectors into floats.
+        """
+        n_lists = self.n_lists or max(1, int(4 * np.sqrt(len(vectors))))
+        n_lists = min(n_lists, len(vectors))
+        sample = vectors
+        if len(vectors) > n_lists * self.max_train_rows:
+            sample = vectors[np.sort(np.random.default_rng(0).choice(len(vectors), n_lists * self.max_train_rows, replace=False))]
+        if decode is not None:
+            sample = decode(sample)
+        self.centroids = kmeans(sample, n_lists, iterations=self.iterations)
+        self._lists = [np.empty(0, dtype=np.int64) for _ in range(n_lists)]
+        self.trained_rows = len(vectors)
+
+    def add(self, vectors, rows):
+        """Assign new vectors with the given row numbers to their nearest list."""
+        if len(rows) == 0:
+            return
+        assignments = assign(normalize(np.asarray(vectors, dtype=np.float32)), self.centroids)
+        rows = np.asarray(rows, dtype=np.int64)
+        order = np.argsort(assignments, kind='stable')
+        lists, starts = np.unique(assignments[order], return_index=True)
+        for i, rows_of_list in zip(lists, np.split(rows[order], starts[1:])):
+            self._lists[i] = np.concatenate([self._lists[i], rows_of_list])
+
+    def search_rows(self, query, nprobe:int=None, top_k:int=1, exclude=None) -> np.ndarray:
+        """
+        Return the candidate rows for a single query vector.
+
+        The `nprobe` lists closest to the query are searched, and further lists in order of
+        similarity until at least `top_k` rows that are not excluded were found, so a
+        search never returns fewer results than asked for while enough rows are left.
+
+        Parameters:
+        query (np.ndarray): The unit-norm query vector.
+        nprobe (int): The number of lists closest to the query to return the rows of.
+        top_k (int): The minimum number of rows to return.
+        exclude (np.ndarray): Optional boolean array marking rows to leave out.
+        """
+        nprobe = min(nprobe or self.nprobe, len(self._lists))
+        sims = self.centroids @ np.asarray(query, dtype=np.float32)
+        order = np.argsort(-sims)
+        candidates = []
+        found = 0
+        for position, i in enumerate(order):
+            if position >= nprobe and found >= top_k:
+                break
+            rows = self._lists[i]
+            if exclude is not None:
+                rows = rows[~exclude[rows]]
+            candidates.append(rows)
+            found += len(rows)
+        return np.concatenate(candidates) if candidates else np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        """The number of rows in the index."""
+        return sum(len(rows) for rows in self._lists)
+
+    def remap(self, new_rows):
+        """Renumber rows after deleted rows were removed. `new_rows` maps old rows to new ones, -1 if removed."""
+        for i, rows in enumerate(self._lists):
+            rows = new_rows[rows]
+            self._lists[i] = rows[rows >= 0]
+
+    def state(self) -> dict:
+        """The arrays needed to restore the index, e.g. to save them with np.savez."""
+        lengths = [len(rows) for rows in self._lists]
+        return {
+            "centroids": self.centroids,
+            "rows": np.concatenate(self._lists) if self._lists else np.empty(0, dtype=np.int64),
+            "offsets": np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+            "trained_rows": np.int64(self.trained_rows),
+        }
+
+    def load_state(self, state):
+        """Restore the index from the arrays returned by `state`."""
+        self.centroids = np.asarray(state["centroids"], dtype=np.float32)
+        rows, offsets = state["rows"], state["offsets"]
+        self._lists = [np.asarray(rows[offsets[i]:offsets[i + 1]], dtype=np.int64) for i in range(len(offsets) - 1)]
+        self.trained_rows = int(state["trained_rows"])
+
+
+EXPAND = 8
+
+class HNSWIndex:
+    '''
+    HNSWIndex is a hierarchical navigable small world graph over the rows of a database.
+
+    Every row is a node linked to up to M similar rows on each layer it is part of, with
+    fewer rows on every higher layer. A search walks greedily down the layers from a
+    single entry point and then explores the bottom layer with a candidate list of size
+    ef_search. Vectors are not copied into the index; they are read through the function
+    given to `attach`.
+
+    The links of a layer are a fixed-width int32 array with one row per node, padded with
+    -1. On the bottom layer a node's links are stored at its row number, the upper layers
+    hold few nodes and map rows to their links with a dict. Searches may run while rows
+    are added, they see every node either with or without its new links. Adding rows and
+    remap must not run at the same time.
+    '''
+    requires_training = False
+
+    def __init__(self, M:int=16, ef_construction:int=200, ef_search:int=64, seed:int=0):
+        """
+        Initialize an empty graph.
+
+        Parameters:
+        M (int): The number of links per node on the upper layers, twice as many on the bottom layer.
+        ef_construction (int): The size of the candidate list used to find the links of a new node.
+        ef_search (int): The default size of the candidate list used by searches.
+        seed (int): Seed for the random layer assignment of new nodes.
+        """
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self._level_multiplier = 1 / np.log(max(M, 2))
+        self._rng = np.random.default_rng(seed)
+        self._fetch = None
+        self.train()
+
+    @property
+    def is_trained(self):
+        """The graph needs no training, it can always be searched and extended."""
+        return True
+
+    @property
+    def trained_rows(self):
+        return len(self)
+
+    def __len__(self):
+        """The number of rows in the graph."""
+        return self._size
+
+    def attach(self, fetch):
+        """Set the function returning the float vectors of a list of rows."""
+        self._fetch = fetch
+
+    def train(self, vectors=None, decode=None):
+        """Drop every node, e.g. before adding all rows again to rebuild the graph."""
+        # The layer of every row, -1 for rows not in the graph
+        self._levels = np.full(0, -1, dtype=np.int8)
+        # One over the norm of the vector of every row, so similarities need no norms
+        self._inverse_norms = np.zeros(0, dtype=np.float32)
+        self._links = []
+        # Per layer above the bottom one, the row of every node and the node of every row
+        self._rows = [None]
+        self._slots = [None]
+        self._size = 0
+        self.entry_point = None
+        self._add_layer()
+
+    def _max_links(self, layer:int) -> int:
+        return 2 * self.M if layer == 0 else self.M
+
+    def _add_layer(self):
+        layer = len(self._links)
+        self._links.append(np.full((0, self._max_links(layer)), -1, dtype=np.int32))
+        if layer > 0:
+            self._rows.append(np.empty(0, dtype=np.int64))
+            self._slots.append({})
+
+    def _reserve(self, layer:int, capacity:int):
+        """Make room for `capacity` nodes on a layer, growing its arrays by doubling."""
+        links = self._links[layer]
+        if capacity <= len(links):
+            return
+        capacity = max(capacity, 2 * len(links), 16)
+        grown = np.full((capacity, links.shape[1]), -1, dtype=np.int32)
+        grown[:len(links)] = links
+        if layer > 0:
+            rows = np.empty(capacity, dtype=np.int64)
+            rows[:len(self._rows[layer])] = self._rows[layer]
+            self._rows[layer] = rows
+        self._links[layer] = grown
+
+    def _slot(self, layer:int, row:int):
+        """The position of a row's links on a layer, None if it is not part of it (yet)."""
+        if layer == 0:
+            return row if row < len(self._links[0]) else None
+        return self._slots[layer].get(row)
+
+    def _normalized(self, rows):
+        return self._fetch(rows) * self._inverse_norms[rows, None]
+
+    def _similarities(self, query, rows):
+        return self._fetch(rows) @ query * self._inverse_norms[rows]
+
+    def _select_neighbors(self, vector, found:list, max_links:int) -> list:
+        """
+        Pick up to `max_links` links for `vector` among `found`, (similarity, row) pairs sorted best first.
+
+        A candidate is preferred if it is closer to `vector` than to every link picked
+        before it, which keeps links spread out in different directions instead of all
+        pointing into the same cluster. Remaining slots are filled with the closest of the
+        skipped candidates. Every candidate is only compared with the links picked so far.
+        """
+        if len(found) <= max_links:
+            return list(found)
+        vectors = self._normalized([row for _, row in found])
+        picked = np.empty((max_links, vectors.shape[1]), dtype=vectors.dtype)
+        selected, skipped = [], []
+        for i, (sim, row) in enumerate(found):
+            if len(selected) == max_links:
+                break
+            if not selected or (picked[:len(selected)] @ vectors[i]).max() < sim:
+                picked[len(selected)] = vectors[i]
+                selected.append((sim, row))
+            else:
+                skipped.append((sim, row))
+        selected.extend(skipped[:max_links - len(selected)])
+        return selected
+
+    def _search_layer(self, query, entry_points:list, ef:int, layer:int, exclude=None) -> list:
+        """Return up to `ef` (similarity, row) pairs closest to `query` on one layer, best first."""
+        links = self._links[layer]
+        slots = self._slots[layer]
+        # The extra last entry is looked up for the -1 padding of the links, and counts as visited
+        visited = np.zeros(len(self._levels) + 1, dtype=bool)
+        visited[-1] = True
+        visited[entry_points] = True
+        sims = self._similarities(query, entry_points).tolist()
+        candidates = [(-sim, row) for sim, row in zip(sims, entry_points)]
+        heapq.heapify(candidates)
+        results = [(sim, row) for sim, row in zip(sims, entry_points) if exclude is None or not exclude[row]]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            # Expand several of the closest candidates at once, so their neighbors are scored in one go
+            expanded = []
+            while candidates and len(expanded) < EXPAND:
+                if len(results) >= ef and -candidates[0][0] < results[0][0]:
+                    break
+                row = heapq.heappop(candidates)[1]
+                slot = row if slots is None else slots.get(row)
+                if slot is not None and slot < len(links):
+                    expanded.append(slot)
+            if not expanded:
+                break
+            neighbors = links[expanded].ravel()
+            try:
+                neighbors = neighbors[~visited[neighbors]]
+            except IndexError:
+                # Links to rows added after this search started are skipped
+                neighbors = neighbors[neighbors < len(visited) - 1]
+                neighbors = neighbors[~visited[neighbors]]
+            if len(neighbors) == 0:
+                continue
+            if len(expanded) > 1:
+                neighbors = np.unique(neighbors)
+            visited[neighbors] = True
+            sims = self._similarities(query, neighbors)
+            if len(results) >= ef:
+                closer = sims > results[0][0]
+                neighbors, sims = neighbors[closer], sims[closer]
+            for sim, neighbor in zip(sims.tolist(), neighbors.tolist()):
+                if len(results) < ef or sim > results[0][0]:
+                    heapq.heappush(candidates, (-sim, neighbor))
+                    # Deleted rows are still walked through, but never returned
+                    if exclude is None or not exclude[neighbor]:
+                        heapq.heappush(results, (sim, neighbor))
+                        if len(results) > ef:
+                            heapq.heappop(results)
+        return sorted(results, reverse=True)
+
+    def _descend(self, query, to_layer:int) -> list:
+        """Walk greedily from the entry point down to `to_layer` and return the closest row found."""
+        entry_points = [self.entry_point]
+        for layer in range(self._levels[self.entry_point], to_layer, -1):
+            entry_points = [self._search_layer(query, entry_points, 1, layer)[0][1]]
+        return entry_points
+
+    def add(self, vectors, rows):
+        """Insert new vectors with the given row numbers into the graph."""
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0:
+            return
+        vectors = np.asarray(vectors, dtype=np.float32)
+        inverse_norms = 1 / np.maximum(np.linalg.norm(vectors, axis=1), np.finfo(np.float32).tiny)
+        vectors = vectors * inverse_norms[:, None]
+        end = int(rows.max()) + 1
+        if end > len(self._levels):
+            capacity = max(end, 2 * len(self._levels))
+            grown = np.zeros(capacity, dtype=np.float32)
+            grown[:len(self._inverse_norms)] = self._inverse_norms
+            self._inverse_norms = grown
+            levels = np.full(capacity, -1, dtype=np.int8)
+            levels[:len(self._levels)] = self._levels
+            self._levels = levels
+        self._reserve(0, len(self._levels))
+        self._inverse_norms[rows] = inverse_norms
+        for vector, row in zip(vectors, rows.tolist()):
+            self._insert(vector, row)
+
+    def _insert(self, vector, row:int):
+        level = int(-np.log(1 - self._rng.random()) * self._level_multiplier)
+        while len(self._links) <= level:
+            self._add_layer()
+        for layer in range(1, level + 1):
+            slot = len(self._slots[layer])
+            self._reserve(layer, slot + 1)
+            self._rows[layer][slot] = row
+            self._slots[layer][row] = slot
+        self._levels[row] = level
+
+        if self.entry_point is None:
+            self.entry_point = row
+            self._size += 1
+            return
+        top = self._levels[self.entry_point]
+        entry_points = self._descend(vector, level)
+        for layer in range(min(level, top), -1, -1):
+            found = self._search_layer(vector, entry_points, self.ef_construction, layer)
+            neighbors = self._select_neighbors(vector, found, self.M)
+            links = self._links[layer]
+            links[self._slot(layer, row), :len(neighbors)] = [neighbor for _, neighbor in neighbors]
+            for sim, neighbor in neighbors:
+                self._link(layer, neighbor, row, sim)
+            entry_points = [neighbor for _, neighbor in found]
+        if level > top:
+            self.entry_point = row
+        self._size += 1
+
+    def _link(self, layer:int, row:int, new:int, sim:float):
+        """
+        Link `row` to `new`, whose similarity to it is `sim`.
+
+        A full list of links keeps its closest ones: `new` replaces the link least similar to `row` if it is closer.
+        """
+        links = self._links[layer][self._slot(layer, row)]
+        free = np.flatnonzero(links < 0)
+        if len(free) > 0:
+            links[free[0]] = new
+            return
+        vectors = self._normalized(np.append(links, row))
+        sims = vectors[:-1] @ vectors[-1]
+        weakest = int(np.argmin(sims))
+        if sim > sims[weakest]:
+            links[weakest] = new
+
+    def search_rows(self, query, ef_search:int=None, top_k:int=1, exclude=None) -> np.ndarray:
+        """
+        Return the candidate rows for a single query vector.
+
+        Parameters:
+        query (np.ndarray): The unit-norm query vector.
+        ef_search (int): The size of the candidate list. Raised to top_k if smaller.
+        top_k (int): The number of results the caller needs.
+        exclude (np.ndarray): Optional boolean array marking rows to leave out, e.g. deleted rows.
+        """
+        if self.entry_point is None:
+            return np.empty(0, dtype=np.int64)
+        query = np.asarray(query, dtype=np.float32)
+        ef = max(ef_search or self.ef_search, top_k)
+        found = self._search_layer(query, self._descend(query, 0), ef, 0, exclude=exclude)
+        return np.array([row for _, row in found], dtype=np.int64)
+
+    def remap(self, new_rows):
+        """
+        Renumber rows after deleted rows were removed. `new_rows` maps old rows to new ones, -1 if removed.
+
+        Must be called while the vectors are still stored under their old rows: nodes that
+        linked to a removed row are relinked to the closest of their remaining links and the
+        links of the removed row, so the graph stays navigable.
+        """
+        new_rows = np.asarray(new_rows, dtype=np.int64)
+        size = int(new_rows.max()) + 1 if len(new_rows) else 0
+        n = min(len(self._levels), len(new_rows))
+        in_graph = np.flatnonzero(self._levels[:n] >= 0)
+        for layer in range(len(self._links)):
+            max_links = self._max_links(layer)
+            if layer == 0:
+                node_rows = in_graph
+                links = self._links[0][in_graph]
+            else:
+                used = len(self._slots[layer])
+                node_rows = self._rows[layer][:used]
+                links = self._links[layer][:used]
+            valid = links >= 0
+            mapped = np.where(valid, new_rows[np.where(valid, links, 0)], -1)
+            kept = new_rows[node_rows] >= 0
+            for i in np.flatnonzero(kept & (valid & (mapped < 0)).any(axis=1)):
+                row = int(node_rows[i])
+                neighbors = links[i][valid[i]].tolist()
+                candidates = {neighbor for neighbor in neighbors if new_rows[neighbor] >= 0}
+                for neighbor in neighbors:
+                    if new_rows[neighbor] < 0:
+                        slot = self._slot(layer, neighbor)
+                        removed_links = self._links[layer][slot]
+                        candidates.update(link for link in removed_links[removed_links >= 0].tolist() if new_rows[link] >= 0)
+                candidates.discard(row)
+                candidates = list(candidates)
+                selected = []
+                if candidates:
+                    vector = self._normalized([row])[0]
+                    sims = self._normalized(candidates) @ vector
+                    found = sorted(zip(sims.tolist(), candidates), reverse=True)
+                    selected = [neighbor for _, neighbor in self._select_neighbors(vector, found, max_links)]
+                mapped[i] = -1
+                mapped[i, :len(selected)] = new_rows[selected]
+            # Move the links to the front of every row, their order does not matter
+            mapped = np.sort(mapped, axis=1)[:, ::-1].astype(np.int32)
+            if layer == 0:
+                links = np.full((size, max_links), -1, dtype=np.int32)
+                links[new_rows[node_rows[kept]]] = mapped[kept]
+                self._links[0] = links
+            else:
+                self._links[layer] = np.ascontiguousarray(mapped[kept])
+                self._rows[layer] = new_rows[node_rows[kept]]
+                self._slots[layer] = {row: slot for slot, row in enumerate(self._rows[layer].tolist())}
+        while len(self._links) > 1 and len(self._slots[-1]) == 0:
+            self._links.pop()
+            self._rows.pop()
+            self._slots.pop()
+        levels = np.full(size, -1, dtype=np.int8)
+        inverse_norms = np.zeros(size, dtype=np.float32)
+        kept_rows = in_graph[new_rows[in_graph] >= 0]
+        levels[new_rows[kept_rows]] = self._levels[kept_rows]
+        inverse_norms[new_rows[kept_rows]] = self._inverse_norms[kept_rows]
+        self._levels = levels
+        self._inverse_norms = inverse_norms
+        self._size = len(kept_rows)
+        if self.entry_point is not None:
+            self.entry_point = int(new_rows[self.entry_point]) if self.entry_point < len(new_rows) else -1
+        if self.entry_point is None or self.entry_point < 0:
+            top = len(self._links) - 1
+            if self._size == 0:
+                self.entry_point = None
+            elif top > 0:
+                self.entry_point = int(self._rows[top][0])
+            else:
+                self.entry_point = int(kept_rows.size and new_rows[kept_rows[0]])
+
+    def state(self) -> dict:
+        """The arrays needed to restore the graph, e.g. to save them with np.savez. They are copies, so the graph may change while they are written."""
+        in_graph = np.flatnonzero(self._levels >= 0)
+        size = int(in_graph[-1]) + 1 if len(in_graph) else 0
+        state = {
+            "levels": self._levels[:size].copy(),
+            "inverse_norms": self._inverse_norms[:size].copy(),
+            "entry_point": np.int64(-1 if self.entry_point is None else self.entry_point),
+            "layers": np.int64(len(self._links)),
+            "links_0": self._links[0][:size].copy(),
+        }
+        for layer in range(1, len(self._links)):
+            used = len(self._slots[layer])
+            state[f"rows_{layer}"] = self._rows[layer][:used].copy()
+            state[f"links_{layer}"] = self._links[layer][:used].copy()
+        return state
+
+    def load_state(self, state):
+        """Restore the graph from the arrays returned by `state`."""
+        self.train()
+        self._levels = np.asarray(state["levels"], dtype=np.int8)
+        entry_point = int(state["entry_point"])
+        self.entry_point = None if entry_point < 0 else entry_point
+        self._size = int((self._levels >= 0).sum())
+        self._inverse_norms = np.array(state["inverse_norms"], dtype=np.float32)
+        for layer in range(int(state["layers"])):
+            if layer > 0:
+                self._add_layer()
+                rows = np.asarray(state[f"rows_{layer}"], dtype=np.int64)
+                self._rows[layer] = rows
+                self._slots[layer] = {row: slot for slot, row in enumerate(rows.tolist())}
+            self._links[layer] = np.array(state[f"links_{layer}"], dtype=np.int32)
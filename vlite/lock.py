@@ -0,0 +1,79 @@
+import collections
+import threading
+from contextlib import contextmanager
+
+
+class ReadWriteLock:
+    '''
+    ReadWriteLock lets any number of threads read at the same time while writes are exclusive.
+
+    Waiting writers are preferred over new readers, so a steady stream of reads cannot
+    starve a write, and get the lock in the order they asked for it, so a steady stream
+    of writes from some threads cannot starve another writer either. Both sides are
+    reentrant: a thread holding the write lock may take the read or write lock again,
+    and a thread holding the read lock may take it again even while a writer is waiting.
+    '''
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._writer_depth = 0
+        # Threads waiting for the write lock, in the order they asked for it
+        self._waiting_writers = collections.deque()
+        self._local = threading.local()
+
+    @contextmanager
+    def read(self):
+        """Hold the lock for reading for the duration of a with block."""
+        me = threading.get_ident()
+        depth = getattr(self._local, "depth", 0)
+        if self._writer == me or depth > 0:
+            # Already inside a read or write section of this thread
+            self._local.depth = depth + 1
+            try:
+                yield
+            finally:
+                self._local.depth -= 1
+            return
+        with self._condition:
+            while self._writer is not None or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+        self._local.depth = 1
+        try:
+            yield
+        finally:
+            self._local.depth = 0
+            with self._condition:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        """Hold the lock exclusively for the duration of a with block."""
+        me = threading.get_ident()
+        with self._condition:
+            if self._writer == me:
+                self._writer_depth += 1
+            else:
+                if getattr(self._local, "depth", 0) > 0:
+                    raise RuntimeError("Cannot upgrade a read lock to a write lock.")
+                self._waiting_writers.append(me)
+                try:
+                    while self._writer is not None or self._readers > 0 or self._waiting_writers[0] != me:
+                        self._condition.wait()
+                finally:
+                    self._waiting_writers.remove(me)
+                    # Let the next writer in line, or the readers, check again
+                    self._condition.notify_all()
+                self._writer = me
+                self._writer_depth = 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer_depth -= 1
+                if self._writer_depth == 0:
+                    self._writer = None
+                    self._condition.notify_all()
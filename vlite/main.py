@@ -1,121 +1,672 @@
-from .utils import chop_and_chunk, cos_sim
-from typing import Any, List, Tuple, Union
+from .utils import iter_pages, normalize, top_k_similar
+from typing import Any, Callable, Iterable, List, Tuple, Union
 from .model import EmbeddingModel
+from .storage import VectorBuffer, WriteAheadLog, ColumnStore, ScalarQuantizer
+from .index import IVFIndex, HNSWIndex
+from .cache import EmbeddingCache, DiskEmbeddingCache
+from .lock import ReadWriteLock
+from .filters import MetadataIndex
+from .metrics import NULL_METRICS, Metrics, print_exporter, timed
 import numpy as np
 import datetime
+import json
+import os
+import queue
+import threading
 import warnings
 import uuid
 import traceback
 
+def _row_map(keys: List[Any]) -> dict:
+    """Map every key that is not None to its position in `keys`, which must not repeat any other key."""
+    rows = dict(zip(keys, range(len(keys))))
+    rows.pop(None, None)
+    return rows
+
 class Data:
-    """Generic data class for vector storage with property special property access."""
+    """
+    Generic data class for vector storage with property special property access.
+
+    Values either live in memory or in a ColumnStore on disk, in which case they are only
+    decoded when accessed. Setting a key always stores the new value in memory.
+
+    The map of keys to rows in the store is never modified, so texts, metadata and their
+    snapshot copies share a single one. Keys set or deleted since are hidden from it instead.
+    """
+
+    def __init__(self, data:dict=None, store:ColumnStore=None, rows:dict=None, hidden:set=None):
+        """
+        Initialize a new Data object.
 
-    def __init__(self, data:dict=None):
-        """Initialize a new Data object."""
+        Parameters:
+        data (dict): Values kept in memory.
+        store (ColumnStore): Column holding values that are decoded on access.
+        rows (dict): Maps keys to their row in `store`. Not modified, so it may be shared.
+        hidden (set): Keys of `rows` whose values in `store` were replaced or deleted.
+        """
         if data is None:
             data = {}
         self._data = data
+        self._store = store
+        self._rows = rows if rows is not None else {}
+        self._hidden = hidden if hidden is not None else set()
+
+    def __setstate__(self, state: dict):
+        """Restore a pickled Data object, including ones pickled before values could live on disk."""
+        self.__init__(state["_data"], state.get("_store"), state.get("_rows"), state.get("_hidden"))
+
+    def _stored(self, key: str) -> bool:
+        """Whether the value of `key` is read from the store."""
+        return key in self._rows and key not in self._hidden
     
     def __getitem__(self, key: str):
         """Get a value from the data object. Key must be a string."""
         key = str(key)
-        return self._data[key]
+        if key in self._data:
+            return self._data[key]
+        if key in self._hidden:
+            raise KeyError(key)
+        return self._store[self._rows[key]]
     
     def __setitem__(self, key: str, value: Any):
         """Set a value in the data object. Key must be a string."""
         key = str(key)
+        if key in self._rows:
+            self._hidden.add(key)
         self._data[key] = value
 
     def __add__(self, data: Union[dict, 'Data']):
         """Add a dict or Data object to the data object."""
         if isinstance(data, dict):
-            self._data.update(data)
+            items = data.items()
         elif isinstance(data, Data):
-            self._data.update(data._data)
+            items = ((key, data[key]) for key in data.keys())
         else:
             raise TypeError("Addition must be a dict or Data object.")
+        for key, value in items:
+            self[key] = value
         return self
 
+    def __contains__(self, key: str) -> bool:
+        """Check whether a key is present in the data object."""
+        key = str(key)
+        return key in self._data or self._stored(key)
+
     def __len__(self):
         """Return the length of the data object."""
-        return len(self._data)
+        return len(self._rows) - len(self._hidden) + len(self._data)
     
     def __delitem__(self, key: str) -> None:
         """Delete an item from the data object."""
-        del self._data[key]
+        key = str(key)
+        if key in self._data:
+            del self._data[key]
+        elif self._stored(key):
+            self._hidden.add(key)
+        else:
+            raise KeyError(key)
     
     def append(self, value: Any):
-        keys = list(self._data.keys())
+        keys = list(self.keys())
         str_int_list = list(map(str, range(len(keys))))
         if keys == str_int_list:
-            key = str(len(self._data))
+            key = str(len(keys))
             self._data[key] = value
         else:
             raise ValueError("Keys are not sequential. Cannot append value. Set a key manually instead.")
     
     def keys(self):
         """Return the keys of the data object."""
-        return self._data.keys()
+        if self._hidden:
+            return [key for key in self._rows if key not in self._hidden] + list(self._data.keys())
+        return list(self._rows.keys()) + list(self._data.keys())
 
     def values(self):
         """Return the values of the data object."""
-        return self._data.values()
+        return [self[key] for key in self.keys()]
+
+    def copy(self) -> 'Data':
+        """A shallow copy that is not affected by later changes to this object, e.g. to write a snapshot from."""
+        return Data(dict(self._data), self._store, self._rows, set(self._hidden))
+
+    def moved(self, snapshot: 'Data', store: ColumnStore, rows: dict, removed: set) -> 'Data':
+        """
+        Return this object with the values of `snapshot`, a copy taken earlier, read from `store` where they were written.
+
+        Parameters:
+        snapshot (Data): The copy that was written to `store`.
+        store (ColumnStore): The column the values of `snapshot` were written to.
+        rows (dict): Maps the keys of `snapshot` to their row in `store`. Not modified, so it may be shared.
+        removed (set): Keys deleted since the copy was taken.
+        """
+        hidden = {key for key in removed if key in rows}
+        data = {}
+        for key, value in self._data.items():
+            if key in rows and key in snapshot._data and snapshot._data[key] is value:
+                # Unchanged since the copy, so it was written
+                continue
+            if key in rows:
+                hidden.add(key)
+            data[key] = value
+        return Data(data, store, rows, hidden)
+
+    def encoded(self, key: str) -> bytes:
+        """Return a value encoded for a ColumnStore, reusing the stored bytes when it was not modified."""
+        key = str(key)
+        if key in self._data:
+            return ColumnStore.encode(self._data[key])
+        return self._store.raw(self._rows[key])
 
 class VLite:
     '''
     vlite is a simple vector database that stores vectors in a numpy array.
+
+    A database may be shared between threads. Searches (remember, remember_many,
+    get_similar_vectors) hold a read lock and run in parallel, which pays off because
+    numpy releases the GIL during the matrix multiplies. Writes (memorize, memorize_many,
+    add_vector, forget, forget_many, build_index) hold the write lock and run one at a
+    time, so a search only ever sees the database before or after a write, never in
+    between. A save only holds the write lock to take a snapshot and to switch over to
+    it, not while the snapshot is written. Texts are embedded before a lock is taken, so
+    embedding does not block other threads. Arrays handed out by the `vectors`, `data`
+    and `metadata` properties are not covered by the lock.
     '''
     _collection = None
     _device = None
     _model = None
-    _data = Data()
-    _metadata = Data()
+    _data = None
+    _metadata = None
     _vectors = None
-    _vector_key_store = []
+    _vector_key_store = None
     _info = None
 
-    def __init__(self, collection:str=None, device:str='mps', model_name:str=None, info:dict=None, DEBUG:bool=False):
+    def __init__(self, collection:str=None, device:str=None, model_name:str=None, info:dict=None, DEBUG:bool=False,
+                 wal_max_bytes:int=64 * 1024 * 1024, wal_max_age:float=None, max_tombstone_ratio:float=0.1,
+                 dtype:str=None, rescore:bool=False, rescore_factor:int=4,
+                 index:str=None, index_params:dict=None, index_min_rows:int=10000,
+                 embedding_cache:EmbeddingCache=None, cache_size:int=4096, embedding_cache_path:str=None,
+                 num_threads:int=None, indexed_fields:List[str]=None, model:EmbeddingModel=None, metrics:Metrics=None):
         """
         Initialize a new VLite database.
 
         Parameters:
         collection (str): The filename to save the database to.
-        device (str): The device to run the model on. Defaults to 'mps'.
+        device (str): The device to run the model on, e.g. 'cpu', 'cuda' or 'mps'. Defaults to mps, then cuda, then cpu, whichever is available.
         model_name (str): The name of the model to use. Defaults to 'sentence-transformers/all-MiniLM-L6-v2'.
+        wal_max_bytes (int): Compact the write-ahead log into the collection file on a background thread once it grows past this size.
+        wal_max_age (float): Compact the write-ahead log once its oldest record is older than this many seconds.
+        max_tombstone_ratio (float): Physically remove deleted rows once they make up more than this fraction of all rows.
+        dtype (str): The precision vectors are stored and searched in: 'float32', 'float16' or 'int8' (scalar-quantized).
+            The int8 range is fitted to the first 1000 rows, or to the rows there are on the first save. Reduced
+            precision takes less memory, but converting the vectors for every search costs some latency, see utils.top_k_similar.
+            Defaults to 'float32'. Existing collections keep the precision they were saved with.
+        rescore (bool): Keep float32 copies of reduced-precision vectors and use them to rescore search candidates.
+        rescore_factor (int): Rescore this many times top_k candidates found in the reduced-precision vectors.
+        index (str): Approximate search index to use instead of scanning every vector: None, 'ivf' or 'hnsw'.
+        index_params (dict): Keyword arguments for the index, e.g. {'n_lists': 1024, 'nprobe': 16} for 'ivf'
+            or {'M': 16, 'ef_construction': 200, 'ef_search': 64} for 'hnsw'.
+        index_min_rows (int): Build an 'ivf' index on save once the collection has this many rows. See also build_index.
+        embedding_cache (EmbeddingCache): Cache of text embeddings to use, e.g. one shared by several databases.
+        cache_size (int): The number of embeddings kept in the default embedding cache. 0 disables caching.
+        embedding_cache_path (str): Keep the embeddings of memorized texts in a persistent cache at this path, so
+            rebuilding a collection only embeds texts that changed. See DiskEmbeddingCache.
+        num_threads (int): The number of threads the model uses on CPU. Defaults to torch's setting.
+        indexed_fields (List[str]): Metadata fields to index so remember can filter on them with `where`. The index is
+            built on the first filtered search, so opening a collection does not read its metadata.
+        model (EmbeddingModel): An already loaded model to use, e.g. one shared by several databases. Overrides
+            model_name, device and num_threads.
+        metrics (Metrics): Records stage timings, latencies and counters of every call, see Metrics. Disabled by default,
+            and with DEBUG every event is printed.
         """
         self.DEBUG = DEBUG
+        if metrics is None:
+            metrics = Metrics([print_exporter]) if DEBUG else NULL_METRICS
+        self.metrics = metrics
+        self._lock = ReadWriteLock()
+        # Held by a save for its whole duration, so only one snapshot is written at a time
+        self._save_lock = threading.Lock()
+        self._compaction = None
+        # Ids deleted while a snapshot is being written, None otherwise
+        self._removed_since_snapshot = None
+        # Held while the search index changes outside the write lock, see _extend_graph
+        self._index_lock = threading.Lock()
+        self._graph_builder = None
 	    # Filename must be unique between runs. Saving to the same file will append vectors to previous run's vectors
         if collection is None:
             current_datetime = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
             collection = f"vlite_{current_datetime}.npz"
             
         self.collection = collection
-        self.device = device
-        self.model = EmbeddingModel(model_name)
+        self.model = model if model is not None else EmbeddingModel(model_name, device=device, num_threads=num_threads, metrics=metrics)
+        self.device = str(self.model.device)
+        if embedding_cache is None and cache_size > 0:
+            embedding_cache = EmbeddingCache(max_entries=cache_size)
+        self.embedding_cache = embedding_cache
+        self.disk_cache = DiskEmbeddingCache(embedding_cache_path, self.model.dimension) if embedding_cache_path else None
+        self._generation = 0
+        self.dtype = np.dtype(dtype or 'float32')
+        if self.dtype not in (np.float32, np.float16, np.int8):
+            raise ValueError("'dtype' must be 'float32', 'float16' or 'int8'.")
+        self._quantizer = ScalarQuantizer(self.model.dimension)
+        self.rescore_factor = rescore_factor
+        full_vectors = None
+        rows = None
         try:
             with np.load(self.collection, allow_pickle=True) as data:
-                self.data = data['texts'].tolist()
-                self.metadata = data['metadata'].tolist()
-                self.vectors = data['vectors']
-                self.info = data["info"].tolist()
-                self._vector_key_store = list(self.data.keys())
+                if 'vectors' in data.files:
+                    # Collections saved before vectors, texts and metadata moved into their own files
+                    self.data = data['texts'].tolist()
+                    self.metadata = data['metadata'].tolist()
+                    self.info = data["info"].tolist()
+                    vectors = data['vectors']
+                    self._vector_key_store = list(self.data.keys())
+                else:
+                    # Vectors, texts and metadata are memory-mapped, so they are only read as they are used
+                    self._generation = int(data['generation'])
+                    # Rows added through add_vector have no id and are saved with an empty key
+                    self._vector_key_store = [key or None for key in data['keys'].tolist()]
+                    self.info = json.loads(str(data['info']))
+                    vectors = np.load(self._snapshot_file('vectors.npy'), mmap_mode='r')
+                    rows = self._open_columns()
+                    if 'dtype' in data.files:
+                        saved_dtype = np.dtype(str(data['dtype']))
+                        if dtype is not None and saved_dtype != self.dtype:
+                            warnings.warn(f"Collection was saved with dtype {saved_dtype}, ignoring dtype {self.dtype}.")
+                        self.dtype = saved_dtype
+                        if self.dtype == np.int8:
+                            self._quantizer = ScalarQuantizer(self.model.dimension, scale=data['scale'], offset=data['offset'])
+                        if rescore and os.path.exists(self._snapshot_file('full.npy')):
+                            full_vectors = np.load(self._snapshot_file('full.npy'), mmap_mode='r')
+                if not ('normalized' in data.files and bool(data['normalized'])):
+                    # Collections saved before rows were normalized on insert
+                    vectors = normalize(self._decode(vectors))
+                    if full_vectors is not None:
+                        full_vectors = normalize(full_vectors)
+                if vectors.dtype != self.dtype:
+                    # Collections saved before the storage dtype was configurable
+                    if rescore:
+                        full_vectors = vectors.astype(np.float32)
+                    if self.dtype == np.int8 and len(vectors) > 0:
+                        self._quantizer = ScalarQuantizer.fit(vectors)
+                    vectors = self._encode(vectors)
+                self.vectors = vectors
         except FileNotFoundError:
             self.data = Data()
             self.metadata = Data()
-            self.vectors = np.empty((0, self.model.dimension))
+            self.vectors = VectorBuffer(self.model.dimension, dtype=self.dtype)
             self.info = info
             self._vector_key_store = []
+            full_vectors = np.empty((0, self.model.dimension), dtype=np.float32)
+
+        # Full precision copies of the vectors, only kept when they differ from the searched ones
+        self.rescore = rescore and self.dtype != np.float32
+        self._full_vectors = None
+        if self.rescore:
+            if full_vectors is None:
+                warnings.warn("Collection was saved without full precision vectors, rescoring is disabled.")
+                self.rescore = False
+            else:
+                self._full_vectors = VectorBuffer.from_array(full_vectors)
+        # Float copies of the rows added while the int8 range is not fitted yet, see _fit_quantizer
+        self._unfitted_vectors = None
+        if self.dtype == np.int8 and self._full_vectors is None and not self._quantizer.fitted and len(self._vectors) == 0:
+            self._unfitted_vectors = VectorBuffer(self.model.dimension, dtype=np.float32)
+
+        # Maps every live id to its row. Deleted rows keep a None key and a tombstone until they are purged.
+        # Copied from the row map of data and metadata when there is one, which is a lot quicker than building it again
+        self._key_index = dict(rows) if rows is not None else _row_map(self._vector_key_store)
+        self._tombstones = set()
+        # Built on the first filtered search rather than here, as it decodes the metadata of every row, see _filter
+        self.indexed_fields = list(indexed_fields) if indexed_fields else None
+        self._metadata_index = None
+        self._metadata_index_lock = threading.Lock()
+        self.max_tombstone_ratio = max_tombstone_ratio
+
+        self.index_min_rows = index_min_rows
+        if index is None:
+            self._index = None
+        elif index == 'ivf':
+            self._index = IVFIndex(**(index_params or {}))
+        elif index == 'hnsw':
+            self._index = HNSWIndex(**(index_params or {}))
+            self._index.attach(lambda rows: self._decode(self.vectors[rows]))
+        else:
+            raise ValueError("'index' must be None, 'ivf' or 'hnsw'.")
+        self._index_kind = index
+        if self._index is not None and os.path.exists(self._snapshot_file('index.npz')):
+            with np.load(self._snapshot_file('index.npz')) as state:
+                if str(state['kind']) == index:
+                    self._index.load_state(state)
+
+        self.wal_max_bytes = wal_max_bytes
+        self.wal_max_age = wal_max_age
+        if os.path.exists(self._snapshot_file('wal')):
+            # Folded into the current snapshot by a save interrupted before it removed the log
+            os.remove(self._snapshot_file('wal'))
+        self._wal = WriteAheadLog(self._sidecar('wal'))
+        # Records of a save that did not finish come before the ones logged after it started
+        for log in (WriteAheadLog(self._snapshot_file('wal', self._generation + 1)), self._wal):
+            for record in log.replay():
+                self._apply(record)
+        if isinstance(self._index, HNSWIndex):
+            # Rows added since the graph was saved, or all of them if it was enabled after they were added
+            self._maybe_extend_graph()
+
+    def _sidecar(self, suffix: str) -> str:
+        """The filename of a file stored next to the collection file."""
+        return f"{os.path.splitext(self.collection)[0]}.{suffix}"
+
+    def _snapshot_file(self, suffix: str, generation: int=None) -> str:
+        """The filename of a file belonging to a snapshot generation. Defaults to the current one."""
+        if generation is None:
+            generation = self._generation
+        return self._sidecar(f"{generation}.{suffix}")
+
+    def _open_columns(self) -> dict:
+        """
+        Point data and metadata at the column stores of the current snapshot generation.
+
+        Returns:
+        dict: The map of keys to rows that data and metadata share.
+        """
+        rows = _row_map(self._vector_key_store)
+        self.data = Data(store=ColumnStore(self._snapshot_file('texts')), rows=rows)
+        self.metadata = Data(store=ColumnStore(self._snapshot_file('metadata')), rows=rows)
+        return rows
+
+    def _apply(self, record: dict):
+        """Apply a write-ahead log record to the in-memory state. Inserts replace existing ids."""
+        if record["op"] == "insert":
+            for id in record["ids"]:
+                if id in self._key_index:
+                    self._remove(id)
+            self._append_rows(record["vectors"], record["ids"])
+            for text, meta, id in zip(record["texts"], record["metadata"], record["ids"]):
+                add_data(text, self, meta, id)
+        elif record["op"] == "delete":
+            for id in record["ids"]:
+                if id in self._key_index:
+                    self._remove(id)
+        self._maybe_purge()
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        """Convert vectors to the storage dtype."""
+        if self.dtype == np.int8:
+            return self._quantizer.encode(vectors)
+        return np.asarray(vectors).astype(self.dtype, copy=False)
+
+    def _decode(self, vectors: np.ndarray) -> np.ndarray:
+        """Convert stored vectors back to float32."""
+        if self.dtype == np.int8:
+            return self._quantizer.decode(vectors)
+        return vectors.astype(np.float32, copy=False)
+
+    def _embed(self, texts: Union[str, List[str]], max_seq_length: int=256, persistent: bool=False, embedder: Any=None) -> np.ndarray:
+        """
+        Embed one or more texts, only running the model for texts missing from the embedding caches.
+
+        Parameters:
+        texts (Union[str, List[str]]): The texts to embed.
+        max_seq_length (int): The number of tokens texts are truncated to.
+        persistent (bool): Also look up and store the embeddings in the on-disk cache, used for ingested texts.
+        embedder (Any): Runs the model instead of the database's own, e.g. an EmbeddingPool.
+
+        Returns:
+        vectors (np.ndarray): One embedding per text, in the order of `texts`.
+        """
+        if isinstance(texts, str):
+            texts = [texts]
+        model = embedder if embedder is not None else self.model
+        caches = [cache for cache in (self.embedding_cache, self.disk_cache if persistent else None) if cache is not None]
+        if not caches:
+            return model.embed(texts=texts, max_seq_length=max_seq_length)
+        keys = [EmbeddingCache.key(model.model_name, max_seq_length, text) for text in texts]
+        vectors = [None] * len(texts)
+        for level, cache in enumerate(caches):
+            for i, key in enumerate(keys):
+                if vectors[i] is None:
+                    vectors[i] = cache.get(key)
+                    if vectors[i] is not None:
+                        self.metrics.count("cache.disk.hits" if cache is self.disk_cache else "cache.memory.hits")
+                        # Promote entries found on disk into the in-memory cache
+                        for faster in caches[:level]:
+                            faster.put(key, vectors[i])
+        missing = {}
+        for text, key, vector in zip(texts, keys, vectors):
+            if vector is None:
+                missing.setdefault(key, text)
+        if self.metrics.enabled:
+            self.metrics.count("cache.misses", len(missing))
+        if missing:
+            embedded = model.embed(texts=list(missing.values()), max_seq_length=max_seq_length)
+            embedded = dict(zip(missing, embedded))
+            for key, vector in embedded.items():
+                for cache in caches:
+                    cache.put(key, vector)
+            vectors = [embedded[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+            if persistent and self.disk_cache is not None:
+                self.disk_cache.flush()
+        return np.vstack(vectors)
+
+    def _append_rows(self, vectors: np.ndarray, ids: List[str]):
+        """Append vectors scaled to unit norm and register their ids in the key store and the id index."""
+        vectors = normalize(np.atleast_2d(vectors))
+        if self._full_vectors is not None:
+            self._full_vectors.append(vectors)
+        start = self._vectors.append(self._encode(vectors))
+        if self._unfitted_vectors is not None:
+            self._unfitted_vectors.append(vectors)
+        if self._can_fit_quantizer() and len(self._vectors) >= ScalarQuantizer.min_fit_rows:
+            self._fit_quantizer()
+        if isinstance(self._index, HNSWIndex):
+            self._maybe_extend_graph()
+        elif self._index is not None and self._index.is_trained:
+            self._index.add(vectors, np.arange(start, len(self._vectors)))
+        for row, id in enumerate(ids, start):
+            self._key_index[id] = row
+        self._vector_key_store.extend(ids)
+
+    def _can_fit_quantizer(self) -> bool:
+        """
+        Whether the int8 range is still to be fitted and float copies of the rows are at hand to fit it to.
+
+        The range is fitted only once, so the rows quantized again are at most the first
+        `ScalarQuantizer.min_fit_rows` and the batch crossing it. Later rows outside the range
+        are clipped, which rescoring makes up for.
+        """
+        return (self.dtype == np.int8 and not self._quantizer.fitted and len(self._vectors) > 0
+                and (self._full_vectors is not None or self._unfitted_vectors is not None))
+
+    def _fit_quantizer(self):
+        """Fit the int8 range to the float copies of the rows and quantize every row again."""
+        vectors = self._full_vectors.array if self._full_vectors is not None else self._unfitted_vectors.array
+        self._quantizer = ScalarQuantizer.fit(vectors)
+        self.vectors = self._quantizer.encode(vectors)
+        # Without rescoring, the float copies were only kept to fit the range
+        self._unfitted_vectors = None
+
+    def _maybe_compact(self):
+        """Start compacting the write-ahead log on a background thread if it crossed the size or age threshold."""
+        if self._wal.size > self.wal_max_bytes or (self.wal_max_age is not None and self._wal.age > self.wal_max_age):
+            if self._compaction is None or not self._compaction.is_alive():
+                self._compaction = threading.Thread(target=self._compact_in_background, name="vlite-compaction", daemon=True)
+                self._compaction.start()
     
     def add_vector(self, vector:Any):
         """
-        Add a vector to the database.
+        Add a vector to the database. The vector is stored scaled to unit norm.
 
         Parameters:
         vector (Any): The vector to add to the database.
         """
-        self.vectors = np.vstack((self.vectors, vector))
+        vector = np.asarray(vector)
+        with self._lock.write():
+            self._append_rows(vector, [None] * (1 if vector.ndim == 1 else vector.shape[0]))
+
+    def _deleted_mask(self) -> np.ndarray:
+        """A boolean array marking deleted rows, or None if there are none."""
+        if not self._tombstones:
+            return None
+        mask = np.zeros(len(self._vector_key_store), dtype=bool)
+        mask[np.fromiter(self._tombstones, dtype=np.int64, count=len(self._tombstones))] = True
+        return mask
+
+    def _search(self, queries: np.ndarray, top_k: int, block_size: int=65536, nprobe: int=None, rows: np.ndarray=None) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+        """
+        Find the rows most similar to every query, skipping deleted rows.
+
+        With `rows`, only those rows are candidates. A small subset of rows is scanned
+        directly, so a restrictive filter makes a search cheaper.
+
+        Stored rows have unit norm, so once the queries are normalized every similarity
+        is a plain dot product.
 
-    def get_similar_vectors(self, vector:Any, top_k:int=5, DEBUG:bool=False):
+        Uses the search index once it is built and scans every vector otherwise. With
+        rescoring enabled, `rescore_factor` times as many candidates are taken from the
+        reduced-precision vectors and ranked again against their float32 copies.
+
+        Returns:
+        top_k_idx (List[np.ndarray]): The rows of the results of every query, best first.
+        similarities (List[np.ndarray]): The similarity scores of the results.
+        """
+        queries = normalize(np.atleast_2d(queries))
+        live = len(self._vector_key_store) - len(self._tombstones) if rows is None else len(rows)
+        top_k = min(top_k, live)
+        if top_k <= 0:
+            return np.empty((len(queries), 0), dtype=np.int64), np.empty((len(queries), 0))
+
+        candidates = min(top_k * self.rescore_factor, live) if self.rescore else top_k
+        metrics = self.metrics
+        metrics.count("search.queries", len(queries))
+        exclude = self._deleted_mask()
+        # int8 codes are scored without decoding them, see top_k_similar
+        quantizer = self._quantizer if self.dtype == np.int8 else None
+        decode = self._decode if self.dtype == np.float16 else None
+        # Scanning a subset beats walking the search index while skipping most of what it finds
+        use_index = self._index is not None and self._index.is_trained and (rows is None or len(rows) > 0.1 * len(self._vector_key_store))
+        if use_index:
+            if rows is not None:
+                exclude = np.ones(len(self._vector_key_store), dtype=bool)
+                exclude[rows] = False
+            with metrics.timer("search.index"):
+                results = [self._search_index(query, candidates, exclude, nprobe) for query in queries]
+            top_k_idx = [idx for idx, _ in results]
+            sims = [sim for _, sim in results]
+        elif rows is not None:
+            metrics.count("search.rows_scanned", len(queries) * len(rows))
+            top_k_idx, sims = top_k_similar(queries, self.vectors[rows], candidates, block_size=block_size,
+                                            decode=decode, normalized=True, metrics=metrics, quantizer=quantizer)
+            top_k_idx = rows[top_k_idx]
+        else:
+            metrics.count("search.rows_scanned", len(queries) * len(self.vectors))
+            top_k_idx, sims = top_k_similar(queries, self.vectors, candidates, block_size=block_size,
+                                            exclude=exclude, decode=decode, normalized=True, metrics=metrics, quantizer=quantizer)
+        if self.rescore:
+            with metrics.timer("search.rescore"):
+                results = [self._rescore(query, idx, top_k) for query, idx in zip(queries, top_k_idx)]
+            top_k_idx = [idx for idx, _ in results]
+            sims = [sim for _, sim in results]
+        return top_k_idx, sims
+
+    def _search_index(self, query: np.ndarray, top_k: int, exclude: np.ndarray, nprobe: int=None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Score only the rows the search index returns as candidates for a single normalized query.
+
+        Rows an HNSW graph does not hold yet, because it is still being extended, are scored as well.
+        """
+        indexed = len(self._index)
+        rows = self._index.search_rows(query, nprobe, top_k=top_k, exclude=exclude)
+        if isinstance(self._index, HNSWIndex):
+            tail = np.arange(indexed, len(self._vector_key_store))
+            if exclude is not None:
+                tail = tail[~exclude[indexed:]]
+            # Rows added to the graph during the search are in the tail already
+            rows = np.concatenate([rows[rows < indexed], tail])
+        rows = np.sort(rows)
+        self.metrics.count("search.rows_scanned", len(rows))
+        top_k = min(top_k, len(rows))
+        if top_k == 0:
+            return rows, np.empty(0)
+        block = self._decode(self.vectors[rows])
+        sims = block @ query
+        top_k_idx = np.argpartition(sims, -top_k)[-top_k:]
+        top_k_idx = top_k_idx[np.argsort(-sims[top_k_idx])]
+        return rows[top_k_idx], sims[top_k_idx]
+
+    def _rescore(self, query: np.ndarray, rows: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Rank candidate rows of a single normalized query again against their full precision vectors."""
+        sims = self._full_vectors.array[rows] @ query
+        order = np.argsort(-sims)[:top_k]
+        return rows[order], sims[order]
+
+    @timed("build_index")
+    def build_index(self):
+        """
+        Train the search index on the vectors in the database and add every row to it.
+
+        An 'ivf' index is also built on save once the database has `index_min_rows` rows, and
+        trained again once it has grown to four times the size it was trained on. An 'hnsw'
+        graph is extended on a background thread as rows are added; rebuilding it helps after
+        many deletes. It is rebuilt without holding the write lock, see _extend_graph.
+        """
+        with self._lock.write():
+            if self._index is None:
+                raise ValueError("This database was created without a search index.")
+            self._purge_tombstones()
+            if len(self._vectors) == 0:
+                return
+            if isinstance(self._index, HNSWIndex):
+                with self._index_lock:
+                    self._index.train()
+            else:
+                self._index.train(self.vectors, decode=self._decode)
+                for start in range(0, len(self._vectors), 65536):
+                    block = self.vectors[start:start + 65536]
+                    self._index.add(self._decode(block), np.arange(start, start + len(block)))
+        if isinstance(self._index, HNSWIndex):
+            self._extend_graph()
+
+    def _maybe_extend_graph(self):
+        """Start adding the rows missing from the HNSW graph on a background thread, unless it is running already."""
+        if len(self._index) < len(self._vectors) and (self._graph_builder is None or not self._graph_builder.is_alive()):
+            self._graph_builder = threading.Thread(target=self._extend_graph_in_background, name="vlite-hnsw", daemon=True)
+            self._graph_builder.start()
+
+    def _extend_graph(self, batch_size: int=256):
+        """
+        Add the rows missing from the HNSW graph, a batch at a time.
+
+        The graph holds the rows up to len(self._index) and searches scan the rows after it,
+        so it is extended holding only the index lock, released after every batch. Searches
+        and writes go on in the meantime, and a purge waits for at most one batch.
+        """
+        while True:
+            with self._index_lock:
+                start = len(self._index)
+                vectors = self.vectors[start:start + batch_size]
+                if len(vectors) == 0:
+                    return
+                self._index.add(self._decode(vectors), np.arange(start, start + len(vectors)))
+
+    def _extend_graph_in_background(self):
+        """Run by the thread started in _maybe_extend_graph."""
+        try:
+            self._extend_graph()
+        except Exception as e:
+            warnings.warn(f"Extending the HNSW graph failed, its missing rows are scanned instead: {e}")
+
+    def _maybe_build_index(self):
+        """Build or retrain the search index if the database crossed the size thresholds."""
+        if self._index is None or not self._index.requires_training:
+            return
+        rows = len(self._vector_key_store) - len(self._tombstones)
+        if not self._index.is_trained and rows >= self.index_min_rows:
+            self.build_index()
+        elif self._index.is_trained and rows > 4 * self._index.trained_rows:
+            self.build_index()
+
+    @timed("get_similar_vectors")
+    def get_similar_vectors(self, vector:Any, top_k:int=5, DEBUG:bool=False, nprobe:int=None):
         """
         Retrieve the most similar vectors to a given vector.
 
@@ -123,41 +674,233 @@ class VLite:
         vector (Any): The vector to search for.
         top_k (int): The number of results to return with the highest similarity.
         DEBUG (bool): Print debug information. Repo maintainer use only.
+        nprobe (int): The number of IVF lists to search, or the ef_search of an HNSW index. Defaults to the index's setting.
         """
-        sims = cos_sim(vector, self.vectors)
-        sims = sims[0]
-        if DEBUG:
-            print("[get_similar_vectors] Sims:", sims.shape)
-
-        top_k_idx = np.argsort(sims)[::-1][:top_k]
+        with self._lock.read():
+            top_k_idx, sims = self._search(vector, top_k, nprobe=nprobe)
+        top_k_idx, sims = top_k_idx[0], sims[0]
         if DEBUG:
             print("[get_similar_vectors] Top k idx:", top_k_idx)
-            print("[get_similar_vectors] Top k sims:", sims[top_k_idx])
+            print("[get_similar_vectors] Top k sims:", sims)
 
-        return top_k_idx, sims[top_k_idx]
+        return top_k_idx, sims
 
+    @timed("memorize")
     def memorize(self, text: str, id: Any=None, metadata: Any=None) -> Tuple[str, List[float]]:
         """
         Add a text to the database.
 
+        Memorizing an id that already exists replaces its entry. A list of texts is
+        added as one entry per text, see memorize_many.
+
         Parameters:
         text (str): The text to add to the database.
         id (str): The id of the text to add to the database.
         metadata (Any): Any metadata to associate with the text.
         """
+        if isinstance(text, (list, tuple)):
+            if id is not None:
+                raise ValueError("Cannot use a single id for a list of texts. Use memorize_many with a list of ids instead.")
+            return self.memorize_many(text, metadata=[dict(metadata or {}) for _ in text])
+
         if id != None:
             id = str(id)
         else:
-            id = uuid.uuid4()
+            id = str(uuid.uuid4())
         
-        encoded_data = self.model.embed(texts=text, device=self.device)
-        self.vectors = np.vstack((self.vectors, encoded_data))
-        self._vector_key_store.append(id)
-        add_data(text, self, metadata, id)
-        self.save()
+        encoded_data = self._embed(text, persistent=True)
+        self._add_embedded([text], [id], [metadata], encoded_data)
         return id, encoded_data[0]
 
-    def remember(self, text:str=None, id:Any=None, top_k:int=5, DEBUG:bool=False):
+    @timed("memorize_many")
+    def memorize_many(self, texts: List[str], ids: List[Any]=None, metadata: List[Any]=None, batch_size: int=256,
+                      embedder: Any=None) -> Tuple[List[str], np.ndarray]:
+        """
+        Add many texts to the database at once.
+
+        The texts are embedded in batches, appended to the vector store in one
+        go, and written to the write-ahead log as a single record.
+
+        Parameters:
+        texts (List[str]): The texts to add to the database.
+        ids (List[Any]): The ids of the texts. Defaults to random uuids.
+        metadata (List[Any]): Metadata to associate with each text.
+        batch_size (int): The number of texts to embed per model call.
+        embedder (Any): Embeds the texts instead of the database's model, e.g. an EmbeddingPool spreading the
+            work over several processes. It must produce vectors of the same model.
+
+        Returns:
+        ids (List[str]): The ids of the added texts.
+        vectors (np.ndarray): The embedding vectors of the added texts.
+        """
+        texts = list(texts)
+        if ids is None:
+            ids = [uuid.uuid4() for _ in texts]
+        ids = [str(id) for id in ids]
+        if metadata is None:
+            metadata = [None] * len(texts)
+        if not len(texts) == len(ids) == len(metadata):
+            raise ValueError("'texts', 'ids' and 'metadata' must have the same length.")
+        if len(set(ids)) != len(ids):
+            raise ValueError("'ids' must be unique.")
+        if len(texts) == 0:
+            return [], np.empty((0, self.model.dimension))
+        if embedder is not None:
+            self._check_embedder(embedder)
+            # The embedder splits the texts into batches for its workers itself
+            batch_size = len(texts)
+
+        encoded_data = np.vstack([
+            self._embed(texts[i:i + batch_size], persistent=True, embedder=embedder)
+            for i in range(0, len(texts), batch_size)
+        ])
+        self._add_embedded(texts, ids, metadata, encoded_data)
+        return ids, encoded_data
+
+    def _check_embedder(self, embedder: Any):
+        """Raise a ValueError unless `embedder` produces vectors of the database's dimension."""
+        if embedder.dimension != self.model.dimension:
+            raise ValueError(f"'embedder' produces vectors of dimension {embedder.dimension}, expected {self.model.dimension}.")
+
+    def _add_embedded(self, texts: List[str], ids: List[str], metadata: List[Any], encoded_data: np.ndarray):
+        """
+        Add entries whose texts are already embedded, replacing existing ids, and log them as one record.
+
+        The record is checked and encoded before anything changes, so vectors of the wrong shape
+        and texts or metadata that cannot be stored raise a ValueError and leave the database and
+        its write-ahead log as they were. A logged record always replays.
+        """
+        if encoded_data.shape != (len(ids), self.model.dimension):
+            raise ValueError(f"Expected vectors of shape {(len(ids), self.model.dimension)}, got {encoded_data.shape}.")
+        entries = {}
+        entries_metadata = {}
+        for text, id, meta in zip(texts, ids, metadata):
+            # A copy, as callers may pass the same dict for several entries
+            meta = dict(meta or {})
+            meta["id"] = id
+            entries[id] = text
+            entries_metadata[id] = meta
+        record = self._wal.encode_insert(ids, texts, [entries_metadata[id] for id in ids], encoded_data)
+
+        with self._lock.write():
+            self._wal.append(record)
+            for id in ids:
+                if id in self._key_index:
+                    self._remove(id)
+            self._append_rows(encoded_data, ids)
+            self.data + entries
+            self.metadata + entries_metadata
+            if self._metadata_index is not None:
+                for id in ids:
+                    self._metadata_index.add(self._key_index[id], entries_metadata[id])
+            self._maybe_compact()
+
+    @timed("ingest")
+    def ingest(self, sources: Union[str, Iterable[Union[str, Iterable[str]]]], chunker: Callable[[str], Iterable[str]]=None,
+               batch_size: int=256, checkpoint_every: int=100000, queue_size: int=4, embedder: Any=None) -> int:
+        """
+        Stream files or other sources of text into the database.
+
+        Reading and chunking, embedding, and adding to the database run as three stages in
+        their own threads, connected by queues of at most `queue_size` batches, so memory
+        stays bounded no matter how large the input is. Every batch is written to the
+        write-ahead log, and the database is saved every `checkpoint_every` chunks and at the end.
+
+        Parameters:
+        sources (Union[str, Iterable]): A file path, or an iterable of file paths and iterables of page texts.
+            PDFs are read page by page and other files as text, see utils.iter_pages.
+        chunker (Callable): Splits the text of a page into chunks. Defaults to the model's token-aware chunker, see EmbeddingModel.chunk.
+        batch_size (int): The number of chunks embedded and added at once.
+        checkpoint_every (int): Save the database after this many chunks. None saves only at the end.
+        queue_size (int): The number of batches that may wait between two stages.
+        embedder (Any): Embeds the chunks instead of the database's model, see memorize_many.
+
+        Returns:
+        count (int): The number of chunks added. Every chunk gets a random id and its source and page in its metadata.
+        """
+        if embedder is not None:
+            self._check_embedder(embedder)
+        if isinstance(sources, (str, os.PathLike)):
+            sources = [sources]
+        if chunker is None:
+            chunker = self.model.chunk
+        stop = threading.Event()
+        chunks = queue.Queue(maxsize=queue_size)
+        embedded = queue.Queue(maxsize=queue_size)
+
+        def put(stage_queue, item):
+            while not stop.is_set():
+                try:
+                    stage_queue.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def read():
+            try:
+                batch = []
+                for source in sources:
+                    path = source if isinstance(source, (str, os.PathLike)) else None
+                    pages = iter_pages(path) if path is not None else source
+                    for page_number, page in enumerate(pages):
+                        for chunk in chunker(page):
+                            if not chunk.strip():
+                                continue
+                            batch.append((chunk, {"source": str(path) if path is not None else None, "page": page_number}))
+                            if len(batch) == batch_size:
+                                put(chunks, batch)
+                                batch = []
+                        if stop.is_set():
+                            return
+                if batch:
+                    put(chunks, batch)
+                put(chunks, None)
+            except BaseException as e:
+                put(chunks, e)
+
+        def embed():
+            while not stop.is_set():
+                try:
+                    batch = chunks.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if batch is None or isinstance(batch, BaseException):
+                    put(embedded, batch)
+                    return
+                try:
+                    put(embedded, (batch, self._embed([text for text, _ in batch], persistent=True, embedder=embedder)))
+                except BaseException as e:
+                    put(embedded, e)
+                    return
+
+        stages = [threading.Thread(target=read, daemon=True), threading.Thread(target=embed, daemon=True)]
+        for stage in stages:
+            stage.start()
+        count = 0
+        checkpointed = 0
+        try:
+            while True:
+                item = embedded.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                batch, vectors = item
+                ids = [str(uuid.uuid4()) for _ in batch]
+                self._add_embedded([text for text, _ in batch], ids, [meta for _, meta in batch], vectors)
+                count += len(batch)
+                if checkpoint_every is not None and count - checkpointed >= checkpoint_every:
+                    self.save()
+                    checkpointed = count
+        finally:
+            stop.set()
+            for stage in stages:
+                stage.join()
+        self.save()
+        return count
+
+    @timed("remember")
+    def remember(self, text:str=None, id:Any=None, top_k:int=5, DEBUG:bool=False, nprobe:int=None, where:dict=None):
         """
         Retrieve a text from the database by id or by text.
 
@@ -166,6 +909,9 @@ class VLite:
         id (str): The id of the text to search for.
         top_k (int): The number of results to return with the highest similarity.
         DEBUG (bool): Print debug information. Repo maintainer use only.
+        nprobe (int): The number of IVF lists to search, or the ef_search of an HNSW index. Defaults to the index's setting.
+        where (dict): Only return entries whose metadata matches this filter, e.g. {"tenant": "acme", "date": {"$gte": 20240101}}.
+            Supports equality, "$in", "$gt", "$gte", "$lt" and "$lte" on the fields in `indexed_fields`.
 
         Returns:
         data (List[str]): The text(s) retrieved from the database.
@@ -173,56 +919,263 @@ class VLite:
         similiarities (List[float]): The similarity score(s) of the text(s) to the query.
         """
         if id is not None:
-            return self.data[id], self.metadata[id], None
+            with self._lock.read():
+                return self.data[id], self.metadata[id], None
         
         if text is not None:
-            sims = cos_sim(self.model.embed(texts=text, device=self.device) , self.vectors)
-            if DEBUG:
-                print("[remember] Vectors:", self.vectors.shape)
-                print("[remember] Sims:", sims.shape)
-                
-            sims = sims[0]
-
-			# top_k cannot be higher than the number of similarities returned
-            top_k = min(top_k, len(sims))
-
-            # Use np.argpartition to partially sort only the top k values
-            top_k_idx = np.argpartition(sims, -top_k)[-top_k:]  
-
-            # Use np.argsort to sort just those top k indices
-            if DEBUG:
-                print(f'remember top_k_idx pre sort {top_k_idx}')
-            top_k_idx = top_k_idx[np.argsort(sims[top_k_idx])[::-1]]
-            if DEBUG:
-                print(f'remember top_k_idx post sort {top_k_idx}')
-            top_k_keys = [self._vector_key_store[idx] for idx in top_k_idx]
-
-            if DEBUG:
-                print("[remember] Top k sims:", sims[top_k_idx])
-            
-            data = [self.data[key] for key in top_k_keys]
-            metadata = [self.metadata[key] for key in top_k_keys]
-            similiarities = sims[top_k_idx]
+            query = self._embed(text)
+            with self._lock.read():
+                if DEBUG:
+                    print("[remember] Vectors:", self.vectors.shape)
+
+                top_k_idx, sims = self._search(query, top_k, nprobe=nprobe, rows=self._filter(where))
+                top_k_idx, similiarities = top_k_idx[0], sims[0]
+                if DEBUG:
+                    print(f'remember top_k_idx {top_k_idx}')
+                    print("[remember] Top k sims:", similiarities)
+                with self.metrics.timer("remember.lookup"):
+                    top_k_keys = [self._vector_key_store[idx] for idx in top_k_idx]
+
+                    data = [self.data[key] for key in top_k_keys]
+                    metadata = [self.metadata[key] for key in top_k_keys]
             return data, metadata, similiarities
     
+    @timed("remember_many")
+    def remember_many(self, texts: List[str], top_k: int=5, block_size: int=65536, nprobe: int=None, where: dict=None) -> List[Tuple[List[Any], List[Any], np.ndarray]]:
+        """
+        Retrieve texts from the database for many queries at once.
+
+        All queries are embedded in one model call and scored against the database with
+        one matrix multiply per block of `block_size` vectors.
+
+        Parameters:
+        texts (List[str]): The texts to search for.
+        top_k (int): The number of results to return per query with the highest similarity.
+        block_size (int): The number of database vectors scored per matrix multiply.
+        nprobe (int): The number of IVF lists to search, or the ef_search of an HNSW index. Defaults to the index's setting.
+        where (dict): Only return entries whose metadata matches this filter, see remember.
+
+        Returns:
+        results (List[Tuple]): One (data, metadata, similarities) tuple per query, as returned by remember.
+        """
+        texts = list(texts)
+        if len(texts) == 0:
+            return []
+        return self._remember_embedded(self._embed(texts), top_k, block_size=block_size, nprobe=nprobe, where=where)
+
+    def _remember_embedded(self, queries: np.ndarray, top_k: int, block_size: int=65536, nprobe: int=None, where: dict=None) -> List[Tuple[List[Any], List[Any], np.ndarray]]:
+        """Search for queries that are already embedded and look up the texts and metadata of the results, see remember_many."""
+        with self._lock.read():
+            top_k_idx, top_k_sims = self._search(queries, top_k, block_size=block_size, nprobe=nprobe, rows=self._filter(where))
+
+            with self.metrics.timer("remember.lookup"):
+                results = []
+                for idx, sims in zip(top_k_idx, top_k_sims):
+                    keys = [self._vector_key_store[row] for row in idx]
+                    results.append(([self.data[key] for key in keys], [self.metadata[key] for key in keys], sims))
+        return results
+
+    def _filter(self, where: dict) -> np.ndarray:
+        """The rows matching a metadata filter, or None without a filter."""
+        if where is None:
+            return None
+        if self.indexed_fields is None:
+            raise ValueError("Filtering needs the metadata fields to be indexed, see 'indexed_fields'.")
+        if self._metadata_index is None:
+            # Called under the read lock, so the metadata does not change while it is indexed, but
+            # other searches may build it at the same time
+            with self._metadata_index_lock:
+                if self._metadata_index is None:
+                    index = MetadataIndex(self.indexed_fields)
+                    for key, row in self._key_index.items():
+                        index.add(row, self.metadata[key])
+                    self._metadata_index = index
+        return self._metadata_index.rows(where)
+
     def forget(self, id: str):
         """Delete an entry from the database by id."""
+        self.forget_many([id])
+
+    @timed("forget_many")
+    def forget_many(self, ids: List[Any]):
+        """
+        Delete many entries from the database by id.
+
+        Deleted rows are only marked as deleted and skipped by search. They are removed
+        from the vector store once they exceed `max_tombstone_ratio` of all rows, or on save.
+
+        Parameters:
+        ids (List[Any]): The ids of the entries to delete.
+        """
+        with self._lock.write():
+            ids = list(dict.fromkeys(str(id) for id in ids))
+            missing = [id for id in ids if id not in self._key_index]
+            if missing:
+                raise KeyError(f"Ids not found: {missing}")
+            self._wal.append_delete(ids)
+            for id in ids:
+                self._remove(id)
+            self._maybe_purge()
+            self._maybe_compact()
+
+    def _remove(self, id: str):
+        """Delete an entry from the in-memory state without logging it."""
+        row = self._key_index.pop(id)
+        self._vector_key_store[row] = None
+        self._tombstones.add(row)
+        if self._removed_since_snapshot is not None:
+            self._removed_since_snapshot.add(id)
+        if self._metadata_index is not None:
+            self._metadata_index.remove(row)
         del self.data[id]
         del self.metadata[id]
-        self.vectors = np.delete(self.vectors, self._vector_key_store.index(id), 0)
-        self._vector_key_store.remove(id)
-        self.save()
+
+    def _maybe_purge(self):
+        """Purge deleted rows if they crossed `max_tombstone_ratio`."""
+        if len(self._tombstones) > self.max_tombstone_ratio * len(self._vector_key_store):
+            self._purge_tombstones()
+
+    def _purge_tombstones(self):
+        """Physically remove deleted rows from the vector store and renumber the remaining ones."""
+        if not self._tombstones:
+            return
+        with self._index_lock:
+            self._purge_tombstones_locked()
+
+    def _purge_tombstones_locked(self):
+        """Purge deleted rows while holding the index lock, so the graph is not extended from rows being moved."""
+        rows = np.fromiter(self._tombstones, dtype=np.int64, count=len(self._tombstones))
+        new_rows = np.arange(len(self._vector_key_store), dtype=np.int64)
+        new_rows[rows] = -1
+        kept = new_rows >= 0
+        new_rows[kept] = np.arange(int(kept.sum()))
+        if self._index is not None and self._index.is_trained:
+            self._index.remap(new_rows)
+        if self._metadata_index is not None:
+            self._metadata_index.remap(new_rows)
+        # A snapshot being written still views the old rows
+        copy = self._removed_since_snapshot is not None
+        self._vectors.delete(rows, copy=copy)
+        if self._full_vectors is not None:
+            self._full_vectors.delete(rows, copy=copy)
+        if self._unfitted_vectors is not None:
+            self._unfitted_vectors.delete(rows)
+        self._vector_key_store = [key for row, key in enumerate(self._vector_key_store) if row not in self._tombstones]
+        self._key_index = _row_map(self._vector_key_store)
+        self._tombstones = set()
             
     def save(self):
-        """Save the database to disk."""
-        with open(self.collection, 'wb') as f:
-            np.savez(
-                        f, 
-                        texts=self.data, 
-                        metadata=self.metadata, 
-                        vectors=self.vectors,
-                        info=self.info
-                    )
+        """
+        Save the database to disk and clear the write-ahead log.
+
+        Vectors, texts and metadata are written to the files of a new snapshot generation,
+        then the collection file is atomically replaced to point at them, so a crash at any
+        point leaves either the old or the new snapshot intact.
+
+        The write lock is only held to take the snapshot and to switch over to it, not while
+        its files are written, so other threads keep searching and writing in the meantime.
+        Writes made while the files are written go to a new write-ahead log.
+        """
+        with self._save_lock:
+            self._write_snapshot()
+
+    def compact(self):
+        """Fold the write-ahead log into the collection file."""
+        self.save()
+
+    def _compact_in_background(self):
+        """Run by the compaction thread started in _maybe_compact."""
+        if not self._save_lock.acquire(blocking=False):
+            # A save is running already and folds in the log
+            return
+        try:
+            self._write_snapshot()
+        except Exception as e:
+            warnings.warn(f"Compacting the write-ahead log failed, it is kept and folded in on the next save: {e}")
+        finally:
+            self._save_lock.release()
+
+    @timed("save")
+    def _write_snapshot(self):
+        """Write a new snapshot generation and switch over to it, see save. The caller holds `_save_lock`."""
+        generation = self._generation + 1
+        # The records logged until the snapshot is taken, folded into it once it is written
+        pending_log = self._snapshot_file('wal', generation)
+        with self._lock.write():
+            self._purge_tombstones()
+            self._maybe_build_index()
+            if self._can_fit_quantizer():
+                # Collections smaller than ScalarQuantizer.min_fit_rows
+                self._fit_quantizer()
+            self._wal.rotate(pending_log)
+            # Rows are only ever appended after the ones viewed here, and purged into a copy until the switch
+            vectors = self.vectors
+            full_vectors = self._full_vectors.array if self._full_vectors is not None else None
+            with self._index_lock:
+                index_state = self._index.state() if self._index is not None and self._index.is_trained else None
+            keys = list(self._vector_key_store)
+            data = self.data.copy()
+            metadata = self.metadata.copy()
+            info = json.dumps(self.info)
+            quantizer = self._quantizer
+            self._removed_since_snapshot = set()
+
+        try:
+            with open(self._snapshot_file('vectors.npy', generation), 'wb') as f:
+                np.save(f, vectors)
+                f.flush()
+                os.fsync(f.fileno())
+            if full_vectors is not None:
+                with open(self._snapshot_file('full.npy', generation), 'wb') as f:
+                    np.save(f, full_vectors)
+                    f.flush()
+                    os.fsync(f.fileno())
+            if index_state is not None:
+                with open(self._snapshot_file('index.npz', generation), 'wb') as f:
+                    np.savez(f, kind=self._index_kind, **index_state)
+                    f.flush()
+                    os.fsync(f.fileno())
+            ColumnStore.write(self._snapshot_file('texts', generation), (data.encoded(key) if key is not None else ColumnStore.encode(None) for key in keys))
+            ColumnStore.write(self._snapshot_file('metadata', generation), (metadata.encoded(key) if key is not None else ColumnStore.encode(None) for key in keys))
+
+            temp = self.collection + '.tmp'
+            with open(temp, 'wb') as f:
+                np.savez(
+                            f, 
+                            keys=np.array([key or '' for key in keys], dtype=str),
+                            info=info,
+                            generation=generation,
+                            dtype=self.dtype.name,
+                            normalized=True,
+                            scale=quantizer.scale,
+                            offset=quantizer.offset
+                        )
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp, self.collection)
+        except BaseException:
+            with self._lock.write():
+                self._removed_since_snapshot = None
+            raise
+
+        rows = _row_map(keys)
+        texts = ColumnStore(self._snapshot_file('texts', generation))
+        metadata_store = ColumnStore(self._snapshot_file('metadata', generation))
+        with self._lock.write():
+            previous = [self._snapshot_file(suffix) for suffix in ('vectors.npy', 'full.npy', 'index.npz', 'texts.bin', 'texts.npy', 'metadata.bin', 'metadata.npy')]
+            self._generation = generation
+            # Drop the in-memory copies of everything that is now in the snapshot
+            removed = self._removed_since_snapshot
+            self.data = self.data.moved(data, texts, rows, removed)
+            self.metadata = self.metadata.moved(metadata, metadata_store, rows, removed)
+            self._removed_since_snapshot = None
+        for path in previous + [pending_log]:
+            if os.path.exists(path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    # Still mapped by another process on platforms that lock mapped files
+                    pass
 
     @property
     def collection(self):
@@ -314,11 +1267,13 @@ class VLite:
     @property
     def vectors(self):
         """Embedding vectors stored in the database."""
-        return self._vectors
+        return self._vectors.array
     
     @vectors.setter
     def vectors(self, value):
         """Embedding vectors stored in the database."""
+        if not isinstance(value, VectorBuffer):
+            value = VectorBuffer.from_array(value)
         self._vectors = value
     
     @property
@@ -355,4 +1310,6 @@ def add_data(data, db: VLite, metadata = None, key = None):
     if metadata is None:
         metadata = {}
     metadata["id"] = key
-    db.metadata[key] = metadata
\ No newline at end of file
+    db.metadata[key] = metadata
+    if db._metadata_index is not None and key in db._key_index:
+        db._metadata_index.add(db._key_index[key], metadata)
\ No newline at end of file
@@ -0,0 +1,171 @@
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# Upper bounds of the latency histogram buckets in seconds, doubling from 1 microsecond to about 2 minutes
+BUCKETS = tuple(1e-6 * 2 ** i for i in range(28))
+
+
+class Histogram:
+    '''Histogram counts durations in fixed exponential buckets, so recording one costs the same no matter how many were recorded.'''
+    def __init__(self, buckets:tuple=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def add(self, value:float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def percentile(self, q:float) -> float:
+        """The upper bound of the bucket holding the q-th percentile, at most the largest value seen."""
+        if self.count == 0:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "min": self.min if self.count else 0.0,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+        }
+
+
+class Metrics:
+    '''
+    Metrics collects stage timings and counters of a database and hands them to exporters.
+
+    Timings are kept in latency histograms and counters are summed, see snapshot. Every
+    event is also passed to each exporter as `exporter(kind, name, value)`, where kind is
+    "timer" (value in seconds) or "counter", so they can be forwarded to a monitoring
+    system as they happen.
+
+    Stages timed by VLite and EmbeddingModel:
+
+        embed.tokenize, embed.forward, embed.pooling   running the model
+        search.similarity, search.top_k                scoring vectors and selecting the best
+        search.index, search.rescore                   approximate search and rescoring candidates
+        remember.lookup                                fetching texts and metadata of the results
+        remember, remember_many, get_similar_vectors, memorize, memorize_many,
+        ingest, forget_many, save, build_index         whole calls, including embedding
+
+    Counters: embed.texts, embed.tokens, embed.batches, cache.memory.hits, cache.disk.hits,
+    cache.misses, search.queries, search.rows_scanned.
+    '''
+    enabled = True
+
+    def __init__(self, exporters:list=None):
+        """
+        Initialize empty metrics.
+
+        Parameters:
+        exporters (list): Callables receiving every event as (kind, name, value).
+        """
+        self.exporters = list(exporters or [])
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, name:str):
+        """Time the body of a with block as stage `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def observe(self, name:str, seconds:float):
+        """Record a duration of stage `name`."""
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.add(seconds)
+        for exporter in self.exporters:
+            exporter("timer", name, seconds)
+
+    def count(self, name:str, value:int=1):
+        """Add `value` to counter `name`."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+        for exporter in self.exporters:
+            exporter("counter", name, value)
+
+    def snapshot(self) -> dict:
+        """
+        The metrics recorded so far.
+
+        Returns:
+        metrics (dict): {"counters": {name: total}, "timers": {name: {"count", "sum", "mean", "min", "max", "p50", "p90", "p99"}}},
+            with durations in seconds.
+        """
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "timers": {name: histogram.summary() for name, histogram in self._histograms.items()},
+            }
+
+    def reset(self):
+        """Forget everything recorded so far."""
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+class NullMetrics(Metrics):
+    '''NullMetrics records nothing, so instrumented code costs next to nothing when metrics are disabled.'''
+    enabled = False
+    _NULL_TIMER = nullcontext()
+
+    def timer(self, name:str):
+        return self._NULL_TIMER
+
+    def observe(self, name:str, seconds:float):
+        pass
+
+    def count(self, name:str, value:int=1):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+def timed(name:str):
+    """Decorate a method of an object with a `metrics` attribute to time every call as stage `name`."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not self.metrics.enabled:
+                return method(self, *args, **kwargs)
+            with self.metrics.timer(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def print_exporter(kind:str, name:str, value) -> None:
+    """An exporter printing every event, used when a database is created with DEBUG=True."""
+    if kind == "timer":
+        print(f"[vlite] {name}: {value * 1000:.3f} ms")
+    else:
+        print(f"[vlite] {name}: +{value}")
@@ -1,79 +1,169 @@
+import threading
+import warnings
+import numpy as np
 import torch
 from transformers import AutoModel, AutoTokenizer
 
-from .utils import visualize_tokens
+from .metrics import NULL_METRICS, Metrics, print_exporter
+from .utils import token_chunks, visualize_tokens
 
 #Mean Pooling - Take attention mask into account for correct averaging
-def mean_pooling(model_output, attention_mask, device="mps"):
-    device = torch.device(device)  # Create a torch.device object for the MPS device
-    token_embeddings = model_output.last_hidden_state.to(device)  # Move token_embeddings to MPS device
-    attention_mask = attention_mask.to(device)  # Move attention_mask to MPS device
+def mean_pooling(model_output, attention_mask, device=None):
+    token_embeddings = model_output.last_hidden_state
+    if device is not None:
+        token_embeddings = token_embeddings.to(device)
+        attention_mask = attention_mask.to(device)
     input_mask_expanded = attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
     return torch.sum(token_embeddings * input_mask_expanded, 1) / torch.clamp(input_mask_expanded.sum(1), min=1e-9)
 
+def resolve_device(device=None):
+    """
+    Pick the torch device to run a model on.
+
+    Parameters:
+    device (str): The requested device, e.g. 'cpu', 'cuda:1' or 'mps'. Falls back to the best
+        available device with a warning if it is not available. Defaults to mps, then cuda, then cpu.
+    """
+    if device is not None:
+        device = torch.device(device)
+        if device.type == 'mps' and not torch.backends.mps.is_available():
+            warnings.warn("MPS is not available, falling back to another device.")
+        elif device.type == 'cuda' and not torch.cuda.is_available():
+            warnings.warn("CUDA is not available, falling back to another device.")
+        else:
+            return device
+    if torch.backends.mps.is_available():
+        return torch.device("mps")
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
 class EmbeddingModel:
     '''
     EmbeddingModel runs a transformer model and returns the embedding for a given text.
+
+    The device is chosen once when the model is created and the model stays on it in
+    eval mode, so embedding a text only moves the inputs and outputs.
     '''
-    def __init__(self, model_name=None, DEBUG=False):
+    def __init__(self, model_name=None, DEBUG=False, device=None, num_threads=None, max_batch_tokens=16384, metrics=None):
+        """
+        Load a model.
+
+        Parameters:
+        model_name (str): The name of the model to use. Defaults to 'sentence-transformers/all-MiniLM-L6-v2'.
+        DEBUG (bool): Print debug information, and every timing and counter unless `metrics` is given.
+        device (str): The device to run the model on. Defaults to mps, then cuda, then cpu, whichever is available.
+        num_threads (int): The number of threads torch uses on CPU. Note that this setting is process wide.
+        max_batch_tokens (int): The maximum number of tokens, padding included, run through the model at once.
+        metrics (Metrics): Records the time spent tokenizing, in the model and pooling. Disabled by default.
+        """
         if model_name is None:
             model_name = 'sentence-transformers/all-MiniLM-L6-v2'
+        self.model_name = model_name
         self.DEBUG=DEBUG
+        if metrics is None:
+            metrics = Metrics([print_exporter]) if DEBUG else NULL_METRICS
+        self.metrics = metrics
+        self.max_batch_tokens = max_batch_tokens
+        # Fast tokenizers raise when called from two threads at once
+        self._tokenizer_lock = threading.Lock()
         self.tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True) # use_fast=True
         
 
         self.model = AutoModel.from_pretrained(model_name)
         self.dimension = self.model.embeddings.position_embeddings.embedding_dim
         self.max_seq_length = self.model.embeddings.position_embeddings.num_embeddings
-        
+
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        self.device = resolve_device(device)
+        self.model.to(self.device)
+        self.model.eval()
 
         if self.DEBUG:
             print("Tokenizer:", self.tokenizer)
+            print("Device:", self.device)
         # print("Dimension:", self.dimension)
         # print("Max sequence length:", self.max_seq_length)
 
-    def embed(self, texts, max_seq_length=256, device="mps"):
+    def embed(self, texts, max_seq_length=256, device=None):
+        """
+        Embed one or more texts into L2-normalized vectors.
 
-        if(torch.backends.mps.is_available()):
-            if self.DEBUG:
-                print("MPS is available")
-            dev = torch.device("mps")
-        else:
-            if self.DEBUG:
-                print("MPS is not available")
-            dev = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-        device = torch.device(dev)  # Create a torch.device object
-        if self.DEBUG:
-            print("Device:", device)
-        self.model.to(device)  # Move the model to the specified device
+        Texts are sorted by token length and run through the model in batches of similar
+        length holding at most `max_batch_tokens` tokens each, so short texts are not
+        padded to the length of the longest one. The results are returned in input order.
 
-        encoded_input = self.tokenizer(texts, padding=True, truncation=True, return_tensors='pt', max_length=max_seq_length)
-        if self.DEBUG:
-            print("Encoded input done",encoded_input['input_ids'].shape)
-        
-        if encoded_input['input_ids'].shape[0] > 1300:
-            if self.DEBUG:
-                print("Encoded input too large, defaulting to CPU")
-            device = torch.device("cpu")
-            self.model.to(device)  # Move the model to the specified device
-        
-        encoded_input = {name: tensor.to(device) for name, tensor in encoded_input.items()}  # Move all input tensors to the specified device
-        if self.DEBUG:
-            print("Encoded input moved to device")
-        
-        with torch.no_grad():
-            model_output = self.model(**encoded_input)
+        Parameters:
+        texts (Union[str, List[str]]): The texts to embed.
+        max_seq_length (int): The number of tokens texts are truncated to.
+        device (str): Unused, the device is chosen when the model is created. Kept for backwards compatibility.
 
-        embeddings = mean_pooling(model_output, encoded_input['attention_mask'], device=device)
-        tensor_embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
-        np_embeddings = tensor_embeddings.cpu().numpy()  # Move tensor to CPU before converting to numpy
+        Returns:
+        embeddings (np.ndarray): One vector per text.
+        """
+        if isinstance(texts, str):
+            texts = [texts]
+        if len(texts) == 0:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        metrics = self.metrics
+        with metrics.timer("embed.tokenize"):
+            with self._tokenizer_lock:
+                encoded_input = self.tokenizer(list(texts), truncation=True, max_length=max_seq_length)
+            lengths = np.array([len(ids) for ids in encoded_input['input_ids']], dtype=np.int64)
+        if metrics.enabled:
+            metrics.count("embed.texts", len(lengths))
+            metrics.count("embed.tokens", int(lengths.sum()))
+        embeddings = np.empty((len(lengths), self.dimension), dtype=np.float32)
+        for batch in self._batches(lengths):
+            features = self._pad(encoded_input, batch, int(lengths[batch].max()))
+            metrics.count("embed.batches")
+            with torch.inference_mode():
+                with metrics.timer("embed.forward"):
+                    model_output = self.model(**features)
+                with metrics.timer("embed.pooling"):
+                    pooled = mean_pooling(model_output, features['attention_mask'])
+                    pooled = torch.nn.functional.normalize(pooled, p=2, dim=1)
+                    embeddings[batch] = pooled.cpu().numpy()  # Move tensor to CPU before converting to numpy
 
         # Visualize tokens with colors
         # tokens = [self.tokenizer.decode([input_id]) for row in encoded_input['input_ids'] for input_id in row]
         # visualize_tokens(tokens)
 
-        return np_embeddings
+        return embeddings
+
+    def chunk(self, texts, max_seq_length=256, overlap=0):
+        """
+        Split texts into chunks that embed without truncation, see utils.token_chunks.
+
+        Parameters:
+        texts (Union[str, Iterable[str]]): The texts to split.
+        max_seq_length (int): The token budget of a chunk, including the special tokens.
+        overlap (int): The number of tokens consecutive chunks of a text share.
+
+        Returns:
+        chunks (Iterator[str]): The chunks, in order.
+        """
+        return token_chunks(texts, self.tokenizer, max_tokens=max_seq_length, overlap=overlap, lock=self._tokenizer_lock)
+
+    def _batches(self, lengths):
+        """Split row numbers, longest first, into batches whose padded size stays within max_batch_tokens."""
+        order = np.argsort(-lengths, kind='stable')
+        start = 0
+        while start < len(order):
+            # Rows are sorted by decreasing length, so the first row sets the padded width of the batch
+            size = max(self.max_batch_tokens // max(int(lengths[order[start]]), 1), 1)
+            yield order[start:start + size]
+            start += size
+
+    def _pad(self, encoded_input, batch, width):
+        """Pad the tokenized rows of a batch to `width` and move them to the model's device."""
+        features = {}
+        for name, rows in encoded_input.items():
+            value = self.tokenizer.pad_token_id if name == 'input_ids' else 0
+            tensor = torch.full((len(batch), width), value, dtype=torch.long)
+            for i, row in enumerate(batch):
+                tensor[i, :len(rows[row])] = torch.tensor(rows[row], dtype=torch.long)
+            features[name] = tensor.to(self.device)
+        return features
 
     def token_count(self, texts):
         tokens = 0
@@ -0,0 +1,162 @@
+import multiprocessing
+import os
+import queue
+import traceback
+import numpy as np
+
+
+def _worker(model_name, num_threads, max_batch_tokens, inbox, outbox):
+    """Load the model once, then embed batches from `inbox` until a None arrives."""
+    try:
+        from .model import EmbeddingModel
+        model = EmbeddingModel(model_name, device='cpu', num_threads=num_threads, max_batch_tokens=max_batch_tokens)
+    except Exception:
+        outbox.put(("error", None, traceback.format_exc()))
+        return
+    outbox.put(("ready", None, model.dimension))
+    while True:
+        task = inbox.get()
+        if task is None:
+            return
+        batch_id, texts, max_seq_length = task
+        try:
+            outbox.put(("result", batch_id, model.embed(texts, max_seq_length=max_seq_length)))
+        except Exception:
+            outbox.put(("error", batch_id, traceback.format_exc()))
+
+
+class EmbeddingPool:
+    '''
+    EmbeddingPool embeds texts in several worker processes, each running its own copy of the model on CPU.
+
+    It has the same embed method as EmbeddingModel and can be passed to VLite.memorize_many
+    to spread bulk ingestion over all cores. Batches are handed to the workers round-robin
+    through bounded queues and the results are put back in input order.
+    '''
+    def __init__(self, model_name:str=None, processes:int=None, batch_size:int=64, queue_size:int=4,
+                 num_threads:int=None, max_batch_tokens:int=16384):
+        """
+        Start the worker processes and wait until each has loaded the model.
+
+        Parameters:
+        model_name (str): The name of the model to use. Defaults to 'sentence-transformers/all-MiniLM-L6-v2'.
+        processes (int): The number of worker processes. Defaults to the number of CPUs.
+        batch_size (int): The number of texts sent to a worker at once.
+        queue_size (int): The number of batches that may wait in each worker's queue.
+        num_threads (int): The number of torch threads per worker. Defaults to the CPUs divided among the workers.
+        max_batch_tokens (int): The token budget of a model call, see EmbeddingModel.
+        """
+        if model_name is None:
+            model_name = 'sentence-transformers/all-MiniLM-L6-v2'
+        cpus = os.cpu_count() or 1
+        self.model_name = model_name
+        self.processes = processes or cpus
+        self.batch_size = batch_size
+        self._calls = 0
+        if num_threads is None:
+            num_threads = max(cpus // self.processes, 1)
+
+        # Forking a process that already initialized torch is unsafe, so workers always start fresh
+        context = multiprocessing.get_context("spawn")
+        self._outbox = context.Queue()
+        self._inboxes = [context.Queue(maxsize=queue_size) for _ in range(self.processes)]
+        self._workers = [
+            context.Process(target=_worker, args=(model_name, num_threads, max_batch_tokens, inbox, self._outbox), daemon=True)
+            for inbox in self._inboxes
+        ]
+        for worker in self._workers:
+            worker.start()
+        self.dimension = None
+        try:
+            for _ in self._workers:
+                kind, _, value = self._get()
+                if kind == "error":
+                    raise RuntimeError(f"Embedding worker failed to start:\n{value}")
+                self.dimension = value
+        except BaseException:
+            self.close()
+            raise
+
+    def embed(self, texts, max_seq_length=256, device=None):
+        """
+        Embed texts in the worker processes.
+
+        Parameters:
+        texts (Union[str, List[str]]): The texts to embed.
+        max_seq_length (int): The number of tokens texts are truncated to.
+        device (str): Unused, workers always run on CPU. Kept for compatibility with EmbeddingModel.embed.
+
+        Returns:
+        embeddings (np.ndarray): One vector per text, in input order.
+        """
+        if isinstance(texts, str):
+            texts = [texts]
+        texts = list(texts)
+        embeddings = np.empty((len(texts), self.dimension), dtype=np.float32)
+        # Texts of similar length end up in the same batch, which keeps padding low in the workers
+        order = np.argsort([len(text) for text in texts], kind='stable')
+        batches = [order[start:start + self.batch_size] for start in range(0, len(order), self.batch_size)]
+
+        # Results left over from a call that failed carry an older call number and are dropped
+        self._calls += 1
+        pending = 0
+        for batch_id, batch in enumerate(batches):
+            inbox = self._inboxes[batch_id % self.processes]
+            while True:
+                try:
+                    inbox.put(((self._calls, batch_id), [texts[i] for i in batch], max_seq_length), timeout=0.1)
+                    break
+                except queue.Full:
+                    pending -= self._collect(batches, embeddings, block=False)
+            pending += 1
+            pending -= self._collect(batches, embeddings, block=False)
+        while pending > 0:
+            pending -= self._collect(batches, embeddings, block=True)
+        return embeddings
+
+    def _collect(self, batches, embeddings, block:bool) -> int:
+        """Store the results that arrived from the workers and return how many there were."""
+        collected = 0
+        while True:
+            if block and collected == 0:
+                kind, task_id, value = self._get()
+            else:
+                try:
+                    kind, task_id, value = self._outbox.get_nowait()
+                except queue.Empty:
+                    return collected
+            if task_id is None or task_id[0] != self._calls:
+                continue
+            if kind == "error":
+                raise RuntimeError(f"Embedding worker failed:\n{value}")
+            embeddings[batches[task_id[1]]] = value
+            collected += 1
+
+    def _get(self):
+        """Wait for the next message from the workers, failing if one of them died."""
+        while True:
+            try:
+                return self._outbox.get(timeout=1)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self._workers):
+                    raise RuntimeError("An embedding worker exited unexpectedly.")
+
+    def close(self):
+        """Stop the worker processes."""
+        for inbox, worker in zip(self._inboxes, self._workers):
+            if worker.is_alive():
+                try:
+                    inbox.put(None, timeout=1)
+                except queue.Full:
+                    worker.terminate()
+        for worker in self._workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+        self._workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,316 @@
+import asyncio
+import http.client
+import json
+import os
+import select
+import socket
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, List, Tuple
+import numpy as np
+from .aio import AsyncVLite
+from .main import VLite
+
+
+class _Handler(BaseHTTPRequestHandler):
+    '''Answers the JSON requests of VLiteClient, see VLiteServer.'''
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == "/health":
+            vlite = self.server.vlite
+            self._reply(200, {"entries": vlite.db.entry_count, "model": vlite.db.model.model_name})
+        else:
+            self._reply(404, {"error": f"Unknown endpoint {self.path}."})
+
+    def do_POST(self):
+        endpoint = self.server.vlite.endpoints.get(self.path)
+        if endpoint is None:
+            self._reply(404, {"error": f"Unknown endpoint {self.path}."})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            self._reply(200, endpoint(request))
+        except KeyError as e:
+            self._reply(404, {"error": f"Not found: {e}"})
+        except (ValueError, TypeError) as e:
+            self._reply(400, {"error": str(e)})
+        except Exception as e:
+            self._reply(500, {"error": f"{type(e).__name__}: {e}"})
+
+    def _reply(self, status:int, body:dict):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def address_string(self):
+        # Clients of a Unix socket have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.vlite.db.DEBUG:
+            super().log_message(format, *args)
+
+
+class _TCPHTTPServer(ThreadingHTTPServer):
+    # Room for bursts of connections from many short-lived clients
+    request_queue_size = 128
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def _results(results) -> dict:
+    data, metadata, similarities = results
+    return {"data": data, "metadata": metadata,
+            "similarities": None if similarities is None else np.asarray(similarities, dtype=float).tolist()}
+
+
+class VLiteServer:
+    '''
+    VLiteServer serves a VLite database over HTTP, on a TCP port or a Unix socket, using only the standard library.
+
+    The model and the collection are loaded once and stay in memory, so clients skip the
+    startup cost. Every connection is handled in its own thread. Single remember and
+    memorize requests are passed through an AsyncVLite, so requests arriving at the same
+    time are embedded and searched as one batch.
+
+    Every endpoint takes and returns JSON:
+
+        POST /remember  {"text": ..., "top_k": 5, "where": {...}} or {"texts": [...]} or {"id": ...}
+        POST /memorize  {"text": ..., "id": ..., "metadata": {...}} or {"texts": [...], "ids": [...], "metadata": [...]}
+        POST /forget    {"id": ...} or {"ids": [...]}
+        POST /save      {}
+        GET  /health
+    '''
+    def __init__(self, db:VLite, host:str="127.0.0.1", port:int=8765, unix_socket:str=None,
+                 max_batch_size:int=64, max_delay:float=0.005):
+        """
+        Bind the server without starting it.
+
+        Parameters:
+        db (VLite): The database to serve.
+        host (str): The address to listen on.
+        port (int): The TCP port to listen on. 0 picks a free port.
+        unix_socket (str): Listen on this Unix socket path instead of a TCP port.
+        max_batch_size (int): The maximum number of requests searched or added as one batch.
+        max_delay (float): The number of seconds a request waits for others to batch with.
+        """
+        self.db = db
+        self.endpoints = {"/remember": self._remember, "/memorize": self._memorize, "/forget": self._forget, "/save": self._save}
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, name="vlite-batcher", daemon=True)
+        self._loop_thread.start()
+        self.batcher = AsyncVLite(db, max_batch_size=max_batch_size, max_delay=max_delay)
+        if unix_socket is not None:
+            if os.path.exists(unix_socket):
+                os.remove(unix_socket)
+            self.httpd = _UnixHTTPServer(unix_socket, _Handler)
+        else:
+            self.httpd = _TCPHTTPServer((host, port), _Handler)
+        self.httpd.vlite = self
+        self.unix_socket = unix_socket
+
+    @property
+    def address(self):
+        """The Unix socket path, or the (host, port) the server listens on."""
+        return self.unix_socket if self.unix_socket is not None else self.httpd.server_address[:2]
+
+    def _batched(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def _remember(self, request:dict) -> dict:
+        if request.get("id") is not None:
+            return _results(self.db.remember(id=request["id"]))
+        top_k = int(request.get("top_k", 5))
+        where = request.get("where")
+        if "texts" in request:
+            return {"results": [_results(results) for results in self.db.remember_many(request["texts"], top_k=top_k, where=where)]}
+        if request.get("text") is None:
+            raise ValueError("'text', 'texts' or 'id' is required.")
+        if where is not None:
+            # Filtered searches cannot share a batch with other queries
+            return _results(self.db.remember(request["text"], top_k=top_k, where=where))
+        return _results(self._batched(self.batcher.remember(request["text"], top_k=top_k)))
+
+    def _memorize(self, request:dict) -> dict:
+        if "texts" in request:
+            ids, _ = self.db.memorize_many(request["texts"], ids=request.get("ids"), metadata=request.get("metadata"))
+            return {"ids": ids}
+        if request.get("text") is None:
+            raise ValueError("'text' or 'texts' is required.")
+        id, _ = self._batched(self.batcher.memorize(request["text"], id=request.get("id"), metadata=request.get("metadata")))
+        return {"id": id}
+
+    def _forget(self, request:dict) -> dict:
+        if "ids" not in request and request.get("id") is None:
+            raise ValueError("'id' or 'ids' is required.")
+        ids = request["ids"] if "ids" in request else [request["id"]]
+        self.db.forget_many(ids)
+        return {"forgotten": len(ids)}
+
+    def _save(self, request:dict) -> dict:
+        self.db.save()
+        return {"entries": self.db.entry_count}
+
+    def serve_forever(self):
+        """Handle requests until shutdown is called from another thread."""
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        """Stop serve_forever, finish the waiting batches and release the socket."""
+        self.httpd.shutdown()
+        self.close()
+
+    def close(self):
+        """Finish the waiting batches and release the socket without stopping a running serve_forever."""
+        if self._loop.is_closed():
+            return
+        self._batched(self.batcher.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._loop.close()
+        self.httpd.server_close()
+        if self.unix_socket is not None and os.path.exists(self.unix_socket):
+            os.remove(self.unix_socket)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _closed_by_peer(sock:socket.socket) -> bool:
+    """Whether the other end closed an idle connection, which then reads as end of file or fails."""
+    if not select.select([sock], [], [], 0)[0]:
+        return False
+    try:
+        return sock.recv(1, socket.MSG_PEEK) == b""
+    except OSError:
+        return True
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path:str, timeout:float):
+        super().__init__("localhost", timeout=timeout)
+        self.unix_socket = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_socket)
+
+
+class VLiteClient:
+    '''
+    VLiteClient talks to a VLiteServer and has the same remember, memorize and forget methods as VLite.
+
+    The connection is kept open between calls. A client must not be shared between threads,
+    use one client per thread instead. A request whose connection broke is only sent again
+    when the server cannot have handled it, or when handling it twice changes nothing, so
+    a lost response never inserts an entry twice.
+    '''
+    def __init__(self, host:str="127.0.0.1", port:int=8765, unix_socket:str=None, timeout:float=60):
+        """
+        Connect to a server.
+
+        Parameters:
+        host (str): The address of the server.
+        port (int): The TCP port of the server.
+        unix_socket (str): Connect to this Unix socket path instead of a TCP port.
+        timeout (float): The number of seconds to wait for a response.
+        """
+        if unix_socket is not None:
+            self._connection = _UnixHTTPConnection(unix_socket, timeout)
+        else:
+            self._connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def _request(self, method:str, path:str, body:dict=None, idempotent:bool=False) -> dict:
+        """Send a request and decode its response. `idempotent` requests are sent again if their response is lost."""
+        payload = None if body is None else json.dumps(body).encode("utf-8")
+        headers = {} if payload is None else {"Content-Type": "application/json"}
+        if self._connection.sock is not None and _closed_by_peer(self._connection.sock):
+            # The server closed the idle connection, connect again rather than fail on it
+            self._connection.close()
+        reused = self._connection.sock is not None
+        try:
+            self._connection.request(method, path, body=payload, headers=headers)
+        except (ConnectionError, http.client.HTTPException):
+            # The server cannot handle a request it did not receive in full, so it is safe to send again
+            self._connection.close()
+            if not reused:
+                raise
+            self._connection.request(method, path, body=payload, headers=headers)
+        try:
+            response = self._connection.getresponse()
+        except (ConnectionError, http.client.HTTPException):
+            # The server may have handled the request before the connection broke
+            self._connection.close()
+            if not (reused and idempotent):
+                raise
+            self._connection.request(method, path, body=payload, headers=headers)
+            response = self._connection.getresponse()
+        result = json.loads(response.read())
+        if response.status == 404:
+            raise KeyError(result["error"])
+        if response.status == 400:
+            raise ValueError(result["error"])
+        if response.status != 200:
+            raise RuntimeError(result["error"])
+        return result
+
+    @staticmethod
+    def _unpack(result:dict) -> Tuple[Any, Any, Any]:
+        similarities = result["similarities"]
+        return result["data"], result["metadata"], None if similarities is None else np.array(similarities)
+
+    def remember(self, text:str=None, id:Any=None, top_k:int=5, where:dict=None):
+        """Retrieve a text by id or by text, see VLite.remember."""
+        return self._unpack(self._request("POST", "/remember", {"text": text, "id": id, "top_k": top_k, "where": where}, idempotent=True))
+
+    def remember_many(self, texts:List[str], top_k:int=5, where:dict=None) -> List[Tuple[List[Any], List[Any], np.ndarray]]:
+        """Retrieve texts for many queries at once, see VLite.remember_many."""
+        result = self._request("POST", "/remember", {"texts": list(texts), "top_k": top_k, "where": where}, idempotent=True)
+        return [self._unpack(results) for results in result["results"]]
+
+    def memorize(self, text:str, id:Any=None, metadata:Any=None) -> str:
+        """Add a text and return its id, see VLite.memorize."""
+        return self._request("POST", "/memorize", {"text": text, "id": id, "metadata": metadata})["id"]
+
+    def memorize_many(self, texts:List[str], ids:List[Any]=None, metadata:List[Any]=None) -> List[str]:
+        """Add many texts and return their ids, see VLite.memorize_many."""
+        return self._request("POST", "/memorize", {"texts": list(texts), "ids": ids, "metadata": metadata})["ids"]
+
+    def forget(self, id:Any):
+        """Delete an entry by id."""
+        self._request("POST", "/forget", {"id": id})
+
+    def forget_many(self, ids:List[Any]):
+        """Delete many entries by id."""
+        self._request("POST", "/forget", {"ids": list(ids)})
+
+    def save(self):
+        """Save the database on the server."""
+        self._request("POST", "/save", {}, idempotent=True)
+
+    def health(self) -> dict:
+        """The number of entries and the model of the served database."""
+        return self._request("GET", "/health", idempotent=True)
+
+    def close(self):
+        """Close the connection."""
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
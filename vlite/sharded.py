@@ -0,0 +1,204 @@
+import heapq
+import itertools
+import json
+import os
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Tuple
+import numpy as np
+from .cache import EmbeddingCache
+from .main import VLite
+from .model import EmbeddingModel
+
+
+class ShardedVLite:
+    '''
+    ShardedVLite spreads a collection over several VLite shards, each saved to its own file.
+
+    Every entry lives in the shard picked by a stable hash of its id, so memorize and
+    forget only touch, log and rewrite that one shard. Searches run on every shard in
+    parallel in a thread pool, which pays off because numpy releases the GIL during the
+    matrix multiplies, and the per-shard top k lists are merged with a heap.
+
+    The shards share one model and one embedding cache, so every text is embedded once.
+    The number of shards is stored next to the shard files and cannot change once the
+    collection was created.
+    '''
+    def __init__(self, collection:str=None, shards:int=None, model_name:str=None, device:str=None,
+                 num_threads:int=None, max_workers:int=None, cache_size:int=4096, embedding_cache_path:str=None, **kwargs):
+        """
+        Open or create a sharded database.
+
+        Parameters:
+        collection (str): The filename of the collection. Shard i is saved to `<name>.<i>.npz` and the number of shards to `<name>.shards.json`.
+        shards (int): The number of shards of a new collection. Defaults to 4, or the number an existing collection was created with.
+        model_name (str): The name of the model to use. Defaults to 'sentence-transformers/all-MiniLM-L6-v2'.
+        device (str): The device to run the model on, see VLite.
+        num_threads (int): The number of threads the model uses on CPU. Defaults to torch's setting.
+        max_workers (int): The number of threads searching shards in parallel. Defaults to the number of shards, at most the number of CPUs.
+        cache_size (int): The number of embeddings kept in the shared embedding cache. 0 disables caching.
+        embedding_cache_path (str): Keep the embeddings of memorized texts in a persistent cache at this path, see VLite.
+        **kwargs: Passed on to every shard, e.g. dtype, index, indexed_fields or a shared metrics. See VLite.
+        """
+        if collection is None:
+            collection = f"vlite_sharded_{uuid.uuid4().hex[:8]}.npz"
+        self.collection = collection
+        base = collection[:-len(".npz")] if collection.endswith(".npz") else collection
+        manifest = f"{base}.shards.json"
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                saved = json.load(f)["shards"]
+            if shards is not None and shards != saved:
+                raise ValueError(f"Collection {collection} has {saved} shards, not {shards}.")
+            shards = saved
+        else:
+            shards = shards or 4
+            if shards < 1:
+                raise ValueError("'shards' must be at least 1.")
+            with open(manifest, 'w') as f:
+                json.dump({"shards": shards}, f)
+
+        self.model = EmbeddingModel(model_name, device=device, num_threads=num_threads, metrics=kwargs.get('metrics'))
+        embedding_cache = EmbeddingCache(max_entries=cache_size) if cache_size > 0 else None
+        # Texts are always embedded through the first shard, so only it needs the persistent cache
+        self.shards = [
+            VLite(f"{base}.{i}.npz", model=self.model, embedding_cache=embedding_cache, cache_size=0,
+                  embedding_cache_path=embedding_cache_path if i == 0 else None, **kwargs)
+            for i in range(shards)
+        ]
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or min(shards, os.cpu_count() or 1),
+                                            thread_name_prefix="vlite-shard")
+
+    def shard_of(self, id:Any) -> int:
+        """The number of the shard an id is stored in."""
+        return zlib.crc32(str(id).encode("utf-8")) % len(self.shards)
+
+    def _group(self, ids:List[str]) -> dict:
+        """Map every shard holding some of `ids` to the positions of its ids."""
+        groups = {}
+        for position, id in enumerate(ids):
+            groups.setdefault(self.shard_of(id), []).append(position)
+        return groups
+
+    def _map(self, function, items) -> list:
+        """Run `function` on every item in the thread pool and return the results in order."""
+        items = list(items)
+        if len(items) == 1:
+            return [function(items[0])]
+        return list(self._executor.map(function, items))
+
+    def memorize(self, text:str, id:Any=None, metadata:Any=None) -> Tuple[str, np.ndarray]:
+        """Add a text to the shard owning its id, see VLite.memorize."""
+        ids, vectors = self.memorize_many([text], ids=[id if id is not None else uuid.uuid4()], metadata=[metadata])
+        return ids[0], vectors[0]
+
+    def memorize_many(self, texts:List[str], ids:List[Any]=None, metadata:List[Any]=None, batch_size:int=256,
+                      embedder:Any=None) -> Tuple[List[str], np.ndarray]:
+        """
+        Add many texts at once, see VLite.memorize_many.
+
+        The texts are embedded together, then every shard adds its own entries in parallel.
+
+        Returns:
+        ids (List[str]): The ids of the added texts.
+        vectors (np.ndarray): The embedding vectors of the added texts.
+        """
+        texts = list(texts)
+        if ids is None:
+            ids = [uuid.uuid4() for _ in texts]
+        ids = [str(id) for id in ids]
+        if metadata is None:
+            metadata = [None] * len(texts)
+        if not len(texts) == len(ids) == len(metadata):
+            raise ValueError("'texts', 'ids' and 'metadata' must have the same length.")
+        if len(set(ids)) != len(ids):
+            raise ValueError("'ids' must be unique.")
+        if len(texts) == 0:
+            return [], np.empty((0, self.model.dimension))
+        if embedder is not None:
+            if embedder.dimension != self.model.dimension:
+                raise ValueError(f"'embedder' produces vectors of dimension {embedder.dimension}, expected {self.model.dimension}.")
+            batch_size = len(texts)
+
+        encoded_data = np.vstack([
+            self.shards[0]._embed(texts[i:i + batch_size], persistent=True, embedder=embedder)
+            for i in range(0, len(texts), batch_size)
+        ])
+
+        def add(group):
+            shard, positions = group
+            self.shards[shard]._add_embedded([texts[i] for i in positions], [ids[i] for i in positions],
+                                             [metadata[i] for i in positions], encoded_data[positions])
+        self._map(add, self._group(ids).items())
+        return ids, encoded_data
+
+    def remember(self, text:str=None, id:Any=None, top_k:int=5, nprobe:int=None, where:dict=None):
+        """
+        Retrieve a text from the database by id or by text, see VLite.remember.
+
+        Returns:
+        data (List[str]): The text(s) retrieved from the database.
+        metadata (List[Any]): The metadata associated with the text(s).
+        similarities (np.ndarray): The similarity score(s) of the text(s) to the query.
+        """
+        if id is not None:
+            return self.shards[self.shard_of(id)].remember(id=id)
+        if text is not None:
+            return self.remember_many([text], top_k=top_k, nprobe=nprobe, where=where)[0]
+
+    def remember_many(self, texts:List[str], top_k:int=5, block_size:int=65536, nprobe:int=None,
+                      where:dict=None) -> List[Tuple[List[Any], List[Any], np.ndarray]]:
+        """
+        Retrieve texts for many queries at once, see VLite.remember_many.
+
+        The queries are embedded once and searched in every shard in parallel. Each shard
+        returns its own top k, best first, and these lists are merged into the overall top k.
+
+        Returns:
+        results (List[Tuple]): One (data, metadata, similarities) tuple per query.
+        """
+        texts = list(texts)
+        if len(texts) == 0:
+            return []
+        queries = self.shards[0]._embed(texts)
+        per_shard = self._map(lambda shard: shard._remember_embedded(queries, top_k, block_size=block_size,
+                                                                     nprobe=nprobe, where=where), self.shards)
+        results = []
+        for query in range(len(texts)):
+            # Results of a shard are sorted best first, so a lazy merge only looks at what it returns
+            merged = heapq.merge(*(zip(-np.asarray(results_of[query][2]), results_of[query][0], results_of[query][1])
+                                   for results_of in per_shard), key=lambda result: result[0])
+            best = list(itertools.islice(merged, top_k))
+            results.append(([data for _, data, _ in best], [metadata for _, _, metadata in best],
+                            np.array([-sim for sim, _, _ in best], dtype=np.float32)))
+        return results
+
+    def forget(self, id:Any):
+        """Delete an entry from the shard owning its id."""
+        self.forget_many([id])
+
+    def forget_many(self, ids:List[Any]):
+        """
+        Delete many entries by id, see VLite.forget_many.
+
+        Raises a KeyError without deleting anything if an id is not in the database.
+        """
+        ids = list(dict.fromkeys(str(id) for id in ids))
+        missing = [id for id in ids if id not in self.shards[self.shard_of(id)]._key_index]
+        if missing:
+            raise KeyError(f"Ids not found: {missing}")
+        self._map(lambda group: self.shards[group[0]].forget_many([ids[i] for i in group[1]]), self._group(ids).items())
+
+    def save(self):
+        """Save every shard, in parallel."""
+        self._map(lambda shard: shard.save(), self.shards)
+
+    def close(self):
+        """Stop the search threads."""
+        self._executor.shutdown(wait=True)
+
+    @property
+    def entry_count(self):
+        """The number of entries in all shards."""
+        return sum(shard.entry_count for shard in self.shards)
@@ -0,0 +1,370 @@
+import json
+import os
+import shutil
+import struct
+import time
+import zlib
+import numpy as np
+
+
+def _to_json(value):
+    """Convert numpy values, which json cannot encode, to plain Python ones."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(value) -> str:
+    """Encode a text or metadata value as JSON, the format it is logged and stored in."""
+    try:
+        return json.dumps(value, default=_to_json)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Texts and metadata must be JSON serializable: {e}") from e
+
+
+class VectorBuffer:
+    '''
+    VectorBuffer is a growable 2D row buffer for embedding vectors.
+
+    Rows are appended into a preallocated array whose capacity doubles when it
+    runs out of room, so appending N rows one at a time moves O(N) bytes in total
+    instead of the O(N^2) of repeated np.vstack calls. `array` is a contiguous
+    view over the live rows only.
+    '''
+    def __init__(self, dimension:int, dtype=np.float64, capacity:int=0):
+        """
+        Initialize an empty buffer.
+
+        Parameters:
+        dimension (int): The number of columns of every row.
+        dtype: The numpy dtype rows are stored as.
+        capacity (int): The number of rows to preallocate.
+        """
+        self._buffer = np.empty((capacity, dimension), dtype=dtype)
+        self._size = 0
+
+    @classmethod
+    def from_array(cls, array):
+        """Wrap an existing 2D array (e.g. a read-only np.memmap) without copying it. The array is only copied once it needs to grow."""
+        array = np.asanyarray(array)
+        if array.ndim == 1:
+            array = array.reshape(1, -1)
+        buffer = cls.__new__(cls)
+        buffer._buffer = array
+        buffer._size = array.shape[0]
+        return buffer
+
+    @property
+    def array(self):
+        """A view over the live rows of the buffer."""
+        return self._buffer[:self._size]
+
+    @property
+    def dimension(self):
+        """The number of columns of every row."""
+        return self._buffer.shape[1]
+
+    @property
+    def dtype(self):
+        """The dtype rows are stored as."""
+        return self._buffer.dtype
+
+    @property
+    def capacity(self):
+        """The number of rows that fit before the buffer has to grow."""
+        return self._buffer.shape[0]
+
+    def __len__(self):
+        return self._size
+
+    def reserve(self, capacity:int):
+        """Make sure at least `capacity` rows fit without another reallocation."""
+        if capacity <= self.capacity and self._buffer.flags.writeable:
+            return
+        capacity = max(capacity, self._size)
+        buffer = np.empty((capacity, self.dimension), dtype=self.dtype)
+        buffer[:self._size] = self._buffer[:self._size]
+        self._buffer = buffer
+
+    def append(self, rows) -> int:
+        """
+        Append one or more rows to the buffer.
+
+        Parameters:
+        rows (Any): A single vector or a 2D array of vectors.
+
+        Returns:
+        start (int): The row index of the first appended row.
+        """
+        rows = np.asarray(rows)
+        if rows.ndim == 1:
+            rows = rows.reshape(1, -1)
+        if rows.shape[1] != self.dimension:
+            raise ValueError(f"Expected vectors of dimension {self.dimension}, got {rows.shape[1]}.")
+
+        start = self._size
+        needed = start + rows.shape[0]
+        if needed > self.capacity or not self._buffer.flags.writeable:
+            self.reserve(max(needed, 2 * self.capacity, 16))
+        self._buffer[start:needed] = rows
+        self._size = needed
+        return start
+
+    def delete(self, index, copy:bool=False):
+        """
+        Delete one or more rows by index, shifting the following rows up in place.
+
+        With `copy`, the remaining rows are moved to a new array instead, leaving views of
+        the old rows handed out earlier intact.
+        """
+        keep = np.ones(self._size, dtype=bool)
+        keep[index] = False
+        count = int(keep.sum())
+        if copy or not self._buffer.flags.writeable:
+            self._buffer = self._buffer[:self._size][keep]
+        else:
+            self._buffer[:count] = self._buffer[:self._size][keep]
+        self._size = count
+
+    def clear(self):
+        """Drop every row while keeping the allocated capacity."""
+        self._size = 0
+
+
+class ScalarQuantizer:
+    '''
+    ScalarQuantizer maps float vectors to int8 codes with a per-dimension scale and offset.
+
+    A value x of dimension d is stored as round((x - offset[d]) / scale[d]) clipped to
+    [-127, 127] and decoded as code * scale[d] + offset[d].
+    '''
+    # The number of rows a range is fitted to as soon as they are added
+    min_fit_rows = 1000
+
+    def __init__(self, dimension:int, scale=None, offset=None):
+        """
+        Initialize a quantizer. Defaults to the range [-1, 1] in every dimension, which holds
+        every component of a unit-norm embedding.
+
+        Parameters:
+        dimension (int): The number of dimensions of the vectors.
+        scale (np.ndarray): The per-dimension step between two codes.
+        offset (np.ndarray): The per-dimension value of code 0.
+        """
+        self.scale = np.full(dimension, 1 / 127, dtype=np.float32) if scale is None else np.asarray(scale, dtype=np.float32)
+        self.offset = np.zeros(dimension, dtype=np.float32) if offset is None else np.asarray(offset, dtype=np.float32)
+
+    @classmethod
+    def fit(cls, vectors):
+        """Create a quantizer covering the per-dimension range of `vectors`."""
+        low = vectors.min(axis=0).astype(np.float32)
+        high = vectors.max(axis=0).astype(np.float32)
+        scale = np.maximum((high - low) / 254, np.finfo(np.float32).eps)
+        return cls(len(scale), scale=scale, offset=(high + low) / 2)
+
+    @property
+    def fitted(self) -> bool:
+        """Whether the range was fitted to data rather than the default [-1, 1]."""
+        return bool(self.offset.any() or (self.scale != np.float32(1 / 127)).any())
+
+    def encode(self, vectors):
+        """Quantize float vectors to int8 codes."""
+        codes = np.rint((np.asarray(vectors, dtype=np.float32) - self.offset) / self.scale)
+        return np.clip(codes, -127, 127).astype(np.int8)
+
+    def decode(self, codes):
+        """Reconstruct float32 vectors from int8 codes."""
+        return codes.astype(np.float32) * self.scale + self.offset
+
+
+class WriteAheadLog:
+    '''
+    WriteAheadLog is an append-only log of inserts and deletes kept next to a collection file.
+
+    Every record is a fixed size header (JSON length, payload length, CRC32) followed by a
+    JSON document describing the operation and, for inserts, the raw vector bytes. A torn
+    record at the end of the file (e.g. from a crash mid-append) is dropped on replay.
+    '''
+    _HEADER = struct.Struct('<III')
+
+    def __init__(self, path:str, fsync:bool=True):
+        """
+        Open a log, creating it on the first append.
+
+        Parameters:
+        path (str): The filename of the log.
+        fsync (bool): Flush every record to stable storage before returning.
+        """
+        self.path = path
+        self.fsync = fsync
+        self._file = None
+        self._started = time.time() if self.size > 0 else None
+
+    @property
+    def size(self):
+        """The size of the log in bytes."""
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    @property
+    def age(self):
+        """Seconds since the oldest record still in the log was written."""
+        if self._started is None:
+            return 0.0
+        return time.time() - self._started
+
+    def encode_insert(self, ids:list, texts:list, metadata:list, vectors) -> bytes:
+        """
+        Encode the insertion of `ids` with their texts, metadata and vectors as a record for `append`.
+
+        Encoding comes first so a value that cannot be logged raises a ValueError before
+        anything was changed.
+        """
+        vectors = np.ascontiguousarray(vectors)
+        header = {
+            "op": "insert",
+            "ids": ids,
+            "texts": texts,
+            "metadata": metadata,
+            "dtype": vectors.dtype.str,
+            "shape": vectors.shape,
+        }
+        return self._encode(header, vectors.tobytes())
+
+    def append_insert(self, ids:list, texts:list, metadata:list, vectors):
+        """Record the insertion of `ids` with their texts, metadata and vectors."""
+        self.append(self.encode_insert(ids, texts, metadata, vectors))
+
+    def append_delete(self, ids:list):
+        """Record the deletion of `ids`."""
+        self.append(self._encode({"op": "delete", "ids": ids}, b""))
+
+    def _encode(self, header:dict, payload:bytes) -> bytes:
+        encoded = dumps(header).encode("utf-8")
+        crc = zlib.crc32(payload, zlib.crc32(encoded))
+        return self._HEADER.pack(len(encoded), len(payload), crc) + encoded + payload
+
+    def append(self, record:bytes):
+        """Write a record returned by `encode_insert` to the end of the log."""
+        if self._file is None:
+            self._file = open(self.path, "ab")
+        self._file.write(record)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        if self._started is None:
+            self._started = time.time()
+
+    def replay(self):
+        """Yield every complete record in the log in the order it was written."""
+        if self.size == 0:
+            return
+        valid = 0
+        with open(self.path, "rb") as f:
+            while True:
+                head = f.read(self._HEADER.size)
+                if len(head) < self._HEADER.size:
+                    break
+                header_length, payload_length, crc = self._HEADER.unpack(head)
+                encoded = f.read(header_length)
+                payload = f.read(payload_length)
+                if len(encoded) < header_length or len(payload) < payload_length:
+                    break
+                if zlib.crc32(payload, zlib.crc32(encoded)) != crc:
+                    break
+                record = json.loads(encoded.decode("utf-8"))
+                if record["op"] == "insert":
+                    record["vectors"] = np.frombuffer(payload, dtype=record["dtype"]).reshape(record["shape"])
+                valid = f.tell()
+                yield record
+        if valid < self.size:
+            with open(self.path, "r+b") as f:
+                f.truncate(valid)
+
+    def rotate(self, path:str):
+        """
+        Move every record to the log at `path` and start over with an empty log.
+
+        If `path` holds records already, e.g. from a compaction that failed, the records
+        are appended to them, so replaying `path` and then this log keeps their order.
+        """
+        self.close()
+        if os.path.exists(self.path):
+            if os.path.exists(path):
+                with open(self.path, "rb") as source, open(path, "ab") as target:
+                    shutil.copyfileobj(source, target)
+                    target.flush()
+                    os.fsync(target.fileno())
+                os.remove(self.path)
+            else:
+                os.replace(self.path, path)
+        self._started = None
+
+    def close(self):
+        """Close the underlying file handle."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ColumnStore:
+    '''
+    ColumnStore is a read-only column of JSON values kept on disk as one contiguous blob plus an offset array.
+
+    Both files are memory-mapped, so opening a store costs the same regardless of its size
+    and only the rows that are actually read get decoded.
+    '''
+    def __init__(self, path:str):
+        """
+        Open a column written by ColumnStore.write.
+
+        Parameters:
+        path (str): The filename prefix of the column. Reads `<path>.bin` and `<path>.npy`.
+        """
+        self.path = path
+        self._offsets = np.load(f"{path}.npy", mmap_mode='r')
+        if os.path.getsize(f"{path}.bin") > 0:
+            self._blob = np.memmap(f"{path}.bin", dtype=np.uint8, mode='r')
+        else:
+            self._blob = np.empty(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, row:int):
+        """Decode the value stored at `row`."""
+        return json.loads(self.raw(row).decode("utf-8"))
+
+    def raw(self, row:int) -> bytes:
+        """The encoded bytes stored at `row`."""
+        return self._blob[self._offsets[row]:self._offsets[row + 1]].tobytes()
+
+    @staticmethod
+    def encode(value) -> bytes:
+        """Encode a value the way it is stored in a column."""
+        return dumps(value).encode("utf-8")
+
+    @staticmethod
+    def write(path:str, encoded_values):
+        """
+        Write a column from an iterable of already encoded values.
+
+        Parameters:
+        path (str): The filename prefix of the column. Writes `<path>.bin` and `<path>.npy`.
+        encoded_values (Iterable[bytes]): The values in row order, as returned by `encode` or `raw`.
+        """
+        offsets = [0]
+        with open(f"{path}.bin", 'wb') as f:
+            for encoded in encoded_values:
+                f.write(encoded)
+                offsets.append(offsets[-1] + len(encoded))
+            f.flush()
+            os.fsync(f.fileno())
+        with open(f"{path}.npy", 'wb') as f:
+            np.save(f, np.array(offsets, dtype=np.int64))
+            f.flush()
+            os.fsync(f.fileno())